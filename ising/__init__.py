@@ -1 +1 @@
-from . import plotter, simulator, thermo, loadingbar, datagen
\ No newline at end of file
+from . import plotter, simulator, thermo, loadingbar, datagen, convergence, sweep, scaling, nfold, tiled, sinks, replay, export
\ No newline at end of file
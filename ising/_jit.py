@@ -0,0 +1,71 @@
+"""
+Numba-compiled Metropolis kernels
+
+Optional backend for simulator, only imported if numba is installed.
+Compiled functions are cached to disk (in __pycache__) so only the very
+first run pays for compilation. The kernels draw random numbers from
+numba's own generator, see seed().
+"""
+
+import numpy as np
+import numba
+
+
+@numba.njit(cache=True)
+def seed(n):
+    """Seed numba's random number generator (separate from numpy's)"""
+
+    np.random.seed(n)
+
+
+@numba.njit(cache=True)
+def _attempt(spins, i, j, b, h, Nx, Ny):
+    """Attempt to flip spin (i, j) with the Metropolis rule"""
+
+    s = spins[i, j]
+    nn = (spins[(i + 1) % Nx, j] + spins[i - 1, j] +
+          spins[i, (j + 1) % Ny] + spins[i, j - 1])
+
+    if np.exp(-2 * b * (nn + h) * s) > np.random.random():
+        spins[i, j] = -s
+
+
+@numba.njit(cache=True)
+def sweep(spins, bs, hs, sequential):
+    """
+    One Metropolis sweep of a grid
+
+    spins: (Nx, Ny)-array -- modified in-place
+    bs, hs: (Nx, Ny)-arrays
+    sequential: bool -- visit every spin in order rather than
+        spins.size randomly chosen ones
+
+    [!] modifies spins array in-place
+    """
+
+    Nx, Ny = spins.shape
+
+    if sequential:
+        for i in range(Nx):
+            for j in range(Ny):
+                _attempt(spins, i, j, bs[i, j], hs[i, j], Nx, Ny)
+    else:
+        for k in range(Nx * Ny):
+            i = np.random.randint(0, Nx)
+            j = np.random.randint(0, Ny)
+            _attempt(spins, i, j, bs[i, j], hs[i, j], Nx, Ny)
+
+
+@numba.njit(cache=True, parallel=True)
+def sweep_ensemble(ensemble, bs, hs, sequential):
+    """
+    One Metropolis sweep of every system, in parallel over the systems
+
+    ensemble: (sysnum, Nx, Ny)-array -- modified in-place
+    bs, hs: (Nx, Ny)-arrays
+
+    [!] modifies ensemble array in-place
+    """
+
+    for k in numba.prange(ensemble.shape[0]):
+        sweep(ensemble[k], bs, hs, sequential)
@@ -0,0 +1,247 @@
+"""Running statistics and simulating until a target precision is reached"""
+
+import numpy as np
+
+from . import thermo
+
+
+class RunningStats:
+    """
+    Running mean, variance and autocovariance of a series over time
+
+    Updated incrementally with new samples only, using Welford's method
+    (merged batch-wise) for the mean and variance. Lagged products are
+    accumulated up to maxlag so the integrated autocorrelation time and
+    an autocorrelation-aware error on the mean can be estimated without
+    keeping the series around.
+
+    All statistics are element-wise over the non-time axes, e.g.: for a
+    (iternum, sysnum)-series, each system gets its own statistics.
+    """
+
+    def __init__(self, maxlag=50):
+        """maxlag: int -- largest time lag to track autocovariance to"""
+
+        self.maxlag = maxlag
+        self.n = 0
+
+        self.mean = None
+        self.m2 = None
+
+        # Everything below is in terms of values shifted by the first
+        # sample, to keep the raw sums of products well-conditioned
+        self._shift = None
+        self._head = None  # first maxlag (shifted) samples
+        self._tail = None  # last maxlag (shifted) samples
+        self._sum = None  # sum of shifted samples
+        self._lagprods = None  # [tau] -> sum_t x_t x_{t+tau}
+
+    def update(self, samples):
+        """
+        Add new samples to the statistics
+
+        samples: (k, ...)-array -- k new samples along the time axis
+        """
+
+        samples = np.asarray(samples, dtype=float)
+        k = samples.shape[0]
+
+        if k == 0:
+            return
+
+        if self.n == 0:
+            shape = samples.shape[1:]
+            self._shift = samples[0].copy()
+            self.mean = np.zeros(shape)
+            self.m2 = np.zeros(shape)
+            self._sum = np.zeros(shape)
+            self._lagprods = np.zeros((self.maxlag + 1,) + shape)
+            self._head = samples[:0] - self._shift
+            self._tail = samples[:0] - self._shift
+
+        x = samples - self._shift
+
+        # 1. Mean and variance: merge batch statistics into running ones
+
+        batch_mean = np.mean(x, axis=0)
+        batch_m2 = np.sum((x - batch_mean)**2, axis=0)
+
+        n = self.n + k
+        delta = batch_mean - (self.mean - self._shift)
+        self.mean = self.mean + delta * k / n
+        self.m2 = self.m2 + batch_m2 + delta**2 * self.n * k / n
+
+        # 2. Lagged products: only pairs whose later element is new
+
+        ext = np.concatenate([self._tail, x], axis=0)
+        old = ext.shape[0] - k
+
+        for tau in range(min(self.maxlag, n - 1) + 1):
+            start = max(old, tau)
+            self._lagprods[tau] += np.sum(
+                ext[start - tau:ext.shape[0] - tau] * ext[start:], axis=0)
+
+        self._sum += np.sum(x, axis=0)
+
+        if self._head.shape[0] < self.maxlag:
+            self._head = np.concatenate([self._head, x], axis=0)
+            self._head = self._head[:self.maxlag]
+
+        self._tail = ext[-self.maxlag:] if self.maxlag > 0 else ext[:0]
+        self.n = n
+
+    def var(self, ddof=1):
+
+        return self.m2 / (self.n - ddof)
+
+    def std(self, ddof=1):
+
+        return np.sqrt(self.var(ddof))
+
+    def autocovariance(self):
+        """
+        Estimate the autocovariance up to maxlag (or the sample count)
+
+        RETURNS: (maxtau, ...)-array
+        """
+
+        maxtau = min(self.maxlag, self.n - 1) + 1
+        mu = self.mean - self._shift
+
+        autocov = []
+        for tau in range(maxtau):
+
+            # sum of the first n - tau and last n - tau samples
+            first = self._sum - np.sum(self._tail[self._tail.shape[0] - tau:],
+                                       axis=0)
+            last = self._sum - np.sum(self._head[:tau], axis=0)
+
+            count = self.n - tau
+            autocov.append(
+                (self._lagprods[tau] - mu * (first + last)) / count + mu**2)
+
+        return np.stack(autocov, axis=0)
+
+    def autocorrelation(self):
+
+        autocov = self.autocovariance()
+        return autocov / autocov[0]
+
+    def tau_int(self, window=5):
+        """
+        Integrated autocorrelation time, in units of samples
+
+        Uses Sokal's automatic windowing: the sum over the normalised
+        autocorrelation is cut off at the first lag W >= window * tau(W).
+        If no such lag exists below maxlag, the full sum is used.
+        """
+
+        rho = self.autocorrelation()
+        taus = np.cumsum(rho, axis=0) - 0.5
+        taus = np.maximum(taus, 0.5)
+
+        lags = np.arange(rho.shape[0]).reshape((-1,) + (1,) * (rho.ndim - 1))
+        cutoff = lags >= window * taus
+
+        # First lag satisfying the cutoff condition, or the last lag
+        ids = np.where(np.any(cutoff, axis=0),
+                       np.argmax(cutoff, axis=0), rho.shape[0] - 1)
+
+        return np.take_along_axis(taus, ids[np.newaxis, ...], axis=0)[0]
+
+    def error(self):
+        """Autocorrelation-aware standard error on the mean"""
+
+        return np.sqrt(self.var(ddof=1) * 2 * self.tau_int() / self.n)
+
+
+def mean_estimate(stats):
+    """
+    Estimate of the mean of a series, averaged over the systems
+
+    stats: RunningStats -- of a (iternum, sysnum)-series
+
+    RETURNS: (float, float) -- estimate, error
+    """
+
+    errs = stats.error()
+    return np.mean(stats.mean), np.sqrt(np.sum(errs**2)) / errs.size
+
+
+def fluct_estimate(stats):
+    """
+    Estimate of the fluctuations (stdev over time) of a series
+
+    The error is estimated from the spread over the ensemble, since the
+    systems are independent.
+
+    stats: RunningStats -- of a (iternum, sysnum)-series
+
+    RETURNS: (float, float) -- estimate, error
+    """
+
+    flucts = stats.std(ddof=1)
+    sysnum = flucts.size
+
+    return np.mean(flucts), np.std(flucts, ddof=1) / np.sqrt(sysnum)
+
+
+def simulate_until(ensemble, estimators, tols, observables=None,
+                   checktime=50, maxtime=5000, maxlag=50, verbose=False):
+    """
+    Keep simulating an ensemble until some estimates are precise enough
+
+    Only the new iterations are processed at every check, so the cost
+    of each check does not grow with the length of the run.
+
+    ensemble: datagen.Ensemble -- already relaxed to equilibrium
+    estimators: dict -- name: callable, taking a dict of RunningStats
+        keyed like observables and returning (estimate, error)
+    tols: dict -- name: float, target relative error for each estimator
+    observables: dict -- name: callable, maps a (t, sysnum, Nx, Ny)-array
+        to a (t, sysnum)-array. Defaults to energy and magnetisation
+    checktime: int -- number of iterations between checks
+    maxtime: int -- give up after this many iterations
+
+    RETURNS: dict -- name: (estimate, error), dict of RunningStats
+    """
+
+    if observables is None:
+        observables = {"energy": thermo.energy,
+                       "magnetisation": thermo.magnetisation}
+
+    stats = {name: RunningStats(maxlag) for name in observables}
+
+    def process(frames):
+        arr = np.asarray(frames)
+        for name, func in observables.items():
+            stats[name].update(func(arr))
+
+    # Start off with whatever's already in the ensemble
+    process(ensemble.asarray())
+    total_iterations = ensemble.iternum
+
+    while True:
+
+        estimates = {name: est(stats) for name, est in estimators.items()}
+        rel_errs = {name: abs(err / est)
+                    for name, (est, err) in estimates.items()}
+
+        if verbose:
+            print(f"{total_iterations} iterations: " + ", ".join(
+                f"{name} = {est:.3f} +/- {err:.3f} ({rel_errs[name]:.3f})"
+                for name, (est, err) in estimates.items()))
+
+        if all(rel_errs[name] < tols[name] for name in estimators):
+            break
+
+        if total_iterations >= maxtime:
+            if verbose:
+                print(f"Exceeded max time of {maxtime}")
+            break
+
+        ensemble.simulate(checktime, reset=False)
+        process(ensemble.iterations[-checktime:])
+        total_iterations += checktime
+
+    return estimates, stats
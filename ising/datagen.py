@@ -2,142 +2,826 @@
 
 import numpy as np
 import numpy.random as npr
+import os
 import json
+import queue
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from warnings import warn
 
 from . import simulator, thermo, loadingbar
 
 
-class DataSet:
-    """Collection of simulated ensembles, allows saving/loading"""
+nwxs = np.newaxis
+
 
-    def __init__(self, path, ensembles=None, load=False):
-        """path: str"""
+class DataSet:
+    """
+    Collection of simulated ensembles, allows saving/loading
+
+    Several processes (or nodes, on a shared filesystem) can add
+    ensembles to the same folder at once: every file is written to a
+    temporary file and renamed into place, and changes to metadata.json
+    are made under a lock file, see _FileLock. The lock is only held to
+    update metadata.json, never while data files are written: new
+    ensembles first reserve their index with a pending entry, which
+    load() skips until the data is in place.
+
+    A DataSet can also be a view of parts of other DataSets, see
+    derive(), in which case its metadata.json refers to their files.
+    """
+
+    def __init__(self, path, ensembles=None, load=False, background=False,
+                 maxqueue=2):
+        """
+        path: str
+        background: bool -- write files from a background thread, so
+            that saving doesn't hold up the simulation. Call flush()
+            (or use the DataSet as a context manager) before exiting
+        maxqueue: int -- number of pending writes after which save()
+            blocks, which bounds the memory held by snapshots
+        """
 
         if ensembles is None:
             self.ensembles = []
         else:
             self.ensembles = list(ensembles)
 
+        # Index of each ensemble on disk (k in ens-k.npy), None if not
+        # saved yet. Differs from the index in self.ensembles when other
+        # processes add ensembles to the same folder.
+        self.file_ids = [None] * len(self.ensembles)
+        self.load_stats = []
+
         self.path = Path(path)
         self.path.mkdir(parents=True, exist_ok=True)
 
+        self._writer = _Writer(maxqueue) if background else None
+
         if load:
             self.load()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _submit(self, func, *args):
+        """Run a write now, or hand it to the background writer"""
+
+        if self._writer is None:
+            func(*args)
+        else:
+            self._writer.submit(func, *args)
+
+    def _snapshot(self, k):
+        """Data of ensemble k, frozen if it is to be written later"""
+
+        ens = self.ensembles[k]
+
+        # Replay ensembles are stored as keyframes, never modified
+        if getattr(ens, "replay", None) is not None:
+            return ens.payload()
+
+        arr = ens.asarray()
+
+        if self._writer is not None:
+            arr = np.array(arr)
+
+        return arr
+
+    def flush(self):
+        """
+        Wait for all pending background writes to finish
+
+        Re-raises the first error that happened in the background.
+        """
+
+        if self._writer is not None:
+            self._writer.flush()
+
+    def close(self):
+        """Flush and stop the background writer, if there is one"""
+
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
     def save(self, ens_index=None):
+        """
+        Save one ensemble, or all of them
 
-        with open(self.path / "metadata.json", "w") as outfile:
-            json.dump(self.get_metadata(), outfile, indent=4)
+        Ensembles which were never saved are appended to the ensembles
+        on disk, the others overwrite their own files. TemperingEnsembles
+        can't be saved as such, add their get_ensembles() instead.
+        """
 
         if ens_index is None:
+            ids = range(len(self.ensembles))
+        else:
+            ids = [ens_index]
+
+        # Checked before anything is written, so no files are orphaned
+        for k in ids:
+            if isinstance(self.ensembles[k], TemperingEnsemble):
+                raise TypeError(
+                    f"ensemble {k} is a TemperingEnsemble, which can't be "
+                    f"saved: add the ensembles from its get_ensembles()")
+
+        for k in ids:
+            self._submit(self._write_ensemble, k,
+                         _ensemble_metadata(self.ensembles[k]),
+                         self._snapshot(k))
+
+    def _write_ensemble(self, k, md, arr):
+        """Write the data and then the metadata of ensemble k"""
+
+        # Reserve an index, so that the data can be written unlocked
+        if self.file_ids[k] is None:
+            with _FileLock(self.path / "metadata.lock"):
+                metadata = _read_metadata(self.path)
+                self.file_ids[k] = len(metadata)
+                metadata.append(dict(md, pending=True))
+                _write_metadata(self.path, metadata)
+
+        fid = self.file_ids[k]
+
+        # Data first, so metadata never lists a missing file
+        if isinstance(arr, dict):
+            _atomic_write(self.path / f"ens-{fid}.npz",
+                          lambda f: np.savez(f, **arr))
+        else:
+            _atomic_write(self.path / f"ens-{fid}.npy",
+                          lambda f: np.save(f, arr))
 
-            for k in range(len(self.ensembles)):
-                np.save(self.path / ("ens-" + str(k) + ".npy"),
-                        self.ensembles[k].asarray())
+        with _FileLock(self.path / "metadata.lock"):
+            metadata = _read_metadata(self.path)
+            metadata[fid] = md
+            _write_metadata(self.path, metadata)
 
+    def save_signs(self, ens_index=None):
+        """
+        Save only the pending flips of saved ensembles, see Ensemble.flip()
+
+        Nothing but metadata.json is rewritten.
+        """
+
+        if ens_index is None:
+            ids = range(len(self.ensembles))
         else:
+            ids = [ens_index]
+
+        for k in ids:
 
-            np.save(self.path / ("ens-" + str(ens_index) + ".npy"),
-                    self.ensembles[ens_index].asarray())
+            if self.file_ids[k] is None:
+                raise ValueError(f"ensemble {k} was never saved")
+
+            signs = getattr(self.ensembles[k], "signs", None)
+            self._submit(self._write_signs, self.file_ids[k],
+                         None if signs is None else signs.tolist())
+
+    def _write_signs(self, fid, signs):
+
+        with _FileLock(self.path / "metadata.lock"):
+
+            metadata = _read_metadata(self.path)
+
+            metadata[fid].pop("signs", None)
+            if signs is not None:
+                metadata[fid]["signs"] = signs
+
+            _write_metadata(self.path, metadata)
 
     def get_metadata(self):
 
-        return [
-            {
-                "grid_shape": ens.grid_shape,
-                "sysnum": ens.sysnum,
-                "identical": ens.identical,
-                "p": ens.p,
-                "b": ens.b,
-                "h": ens.h,
-                "iternum": ens.iternum
-            } for ens in self.ensembles
-        ]
+        return [_ensemble_metadata(ens) for ens in self.ensembles]
 
-    def load(self):
+    def load(self, mmap=False, select=None, threads=4, verbose=False):
+        """
+        mmap: bool -- memory-map the data files rather than reading them,
+            so that ensembles bigger than memory can be analysed in
+            chunks, see Ensemble.iter_chunks() and thermo.blockwise
+        select: list of ints OR callable OR None -- only load the
+            ensembles with these indices on disk, or those for which
+            select(metadata) is True, where metadata is a dict with the
+            keys of get_metadata(). None loads everything. Ensembles
+            which are still being written are skipped
+        threads: int -- number of files to read in parallel
+        verbose: bool -- print the throughput of every file
+
+        The indices on disk of the loaded ensembles are in file_ids, and
+        the file, time, size and throughput of every read in load_stats.
+        """
 
+        self.flush()
         self.ensembles = []
+        self.file_ids = []
+        self.load_stats = []
 
         with open(self.path / "metadata.json", "r") as mdfile:
             metadata = json.load(mdfile)
 
-        ensemble_count = len(metadata)
+        ids = _select_ids(metadata, select)
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            results = pool.map(
+                lambda k: self._load_ensemble(k, dict(metadata[k]), mmap),
+                ids)
+
+            # Results come back in order, as soon as each is ready
+            for k, (ens, stats) in zip(ids, results):
+
+                self.add_ensemble(ens)
+                self.file_ids[-1] = k
+                self.load_stats.append(stats)
 
-        for k in range(ensemble_count):
+                if verbose:
+                    print(f"{stats['file']}: {stats['bytes'] / 1e6:.1f} MB "
+                          f"in {stats['time']:.3f} s "
+                          f"({stats['throughput'] / 1e6:.1f} MB/s)")
 
-            md = metadata[k]
-            iternum = md.pop("iternum")
-            ens = Ensemble(**md)
+    def _load_ensemble(self, k, md, mmap):
+        """Read ensemble k from disk, RETURNS: Ensemble, dict of stats"""
 
-            ens_data = np.load(self.path / f"ens-{k}.npy")
+        start = time.perf_counter()
 
-            # Check data integrity
-            if not ens_data.shape == (iternum, ens.sysnum, *ens.grid_shape):
-                error_message = (
-                    f"Integrity check failure\n"
-                    f"data path: {self.path}\n"
-                    f"ens. index: {k}\n\n"
-                    f"Ensemble data had shape {ens_data.shape} "
-                    f"when {(iternum, ens.sysnum, *ens.grid_shape)} was expected!"
-                )
-                raise RuntimeError(error_message)
+        if md.pop("pending", False):
+            raise RuntimeError(f"ensemble {k} in {self.path} is still being "
+                               f"written, or its writer crashed")
 
-            ens.init_state = ens_data[0]
-            ens.iterations = list(ens_data)
-            ens.iternum = iternum
+        iternum = md.pop("iternum")
+        view = md.pop("view", None)
+        signs = md.pop("signs", None)
+        replay_md = md.pop("replay", None)
 
-            self.add_ensemble(ens)
+        if replay_md is not None:
+
+            from . import replay
+
+            filename = self.path / f"ens-{k}.npz"
+            ens = replay.ReplayEnsemble.load(filename, md, replay_md, iternum)
+
+            elapsed = time.perf_counter() - start
+            nbytes = filename.stat().st_size
+
+            return ens, {"file_id": k, "file": filename, "bytes": nbytes,
+                         "time": elapsed, "throughput": nbytes / elapsed}
+
+        ens = Ensemble(**md)
+
+        if view is None:
+            filename = self.path / f"ens-{k}.npy"
+            ens_data = np.load(filename, mmap_mode="r" if mmap else None)
+        else:
+            filename = self.path / view["source"]
+            ens_data = _open_view(self.path, view)
+
+        # Older datasets were saved with wider dtypes. Views are always
+        # memory-mapped, so that only their part of the file is read
+        if not mmap:
+            if view is None:
+                ens_data = ens_data.astype(simulator.SPIN_DTYPE, copy=False)
+            else:
+                ens_data = np.array(ens_data, dtype=simulator.SPIN_DTYPE)
+
+        # Check data integrity
+        if not ens_data.shape == (iternum, ens.sysnum, *ens.grid_shape):
+            error_message = (
+                f"Integrity check failure\n"
+                f"data path: {self.path}\n"
+                f"ens. index: {k}\n\n"
+                f"Ensemble data had shape {ens_data.shape} "
+                f"when {(iternum, ens.sysnum, *ens.grid_shape)} was expected!"
+            )
+            raise RuntimeError(error_message)
+
+        ens.iterations = TrajectoryBuffer.from_array(ens_data)
+        ens.init_state = ens.iterations[0]
+        ens.iternum = iternum
+
+        if signs is not None:
+            ens.signs = np.array(signs, dtype=simulator.SPIN_DTYPE)
+
+        elapsed = time.perf_counter() - start
+        nbytes = ens_data.nbytes
+
+        return ens, {"file_id": k, "file": filename, "bytes": nbytes,
+                     "time": elapsed,
+                     "throughput": nbytes / elapsed if elapsed > 0 else np.inf}
+
+    def derive(self, path, select=None, start=0, stop=None, systems=None,
+               link=False):
+        """
+        Create a DataSet which is a view of parts of this one
+
+        No data is copied: the new DataSet only stores references to the
+        files of this one, and which iterations and systems to use. They
+        are memory-mapped when loaded. Ensembles of the new DataSet which
+        are saved are written out in full as its own files.
+
+        path: str OR Path -- folder of the new DataSet. Views are added
+            to whatever it already holds
+        select: see load()
+        start, stop: int OR None -- keep iterations start:stop of every
+            ensemble, e.g.: start=relaxtime does what trim_init() does
+        systems: list of ints OR slice OR None -- keep these systems.
+            Slices and evenly spaced lists stay zero-copy when loaded
+        link: bool -- hard-link the data files into the new folder, so
+            that the view survives the original files being deleted.
+            Both folders must be on the same filesystem
+
+        RETURNS: DataSet -- the new DataSet, loaded with mmap
+        """
+
+        self.flush()
+        metadata = _read_metadata(self.path)
+
+        derived = DataSet(path)
+
+        with _FileLock(derived.path / "metadata.lock"):
+
+            derived_md = _read_metadata(derived.path)
+
+            for k in _select_ids(metadata, select):
+
+                md = dict(metadata[k])
+                if md.pop("pending", False):
+                    continue
+
+                view = md.pop("view", None)
+
+                if "replay" in md:
+                    raise ValueError(f"ensemble {k} is a replay ensemble, "
+                                     f"which can't be viewed")
+
+                # A view of a view refers straight to the original file
+                if view is None:
+                    view = {"source": f"ens-{k}.npy", "start": 0,
+                            "stop": md["iternum"], "systems": None}
+                source = (self.path / view["source"]).resolve()
+
+                t0, t1, _ = slice(start, stop).indices(md["iternum"])
+
+                ids = view["systems"]
+                if ids is None:
+                    ids = range(md["sysnum"])
+                if systems is not None:
+
+                    if isinstance(systems, slice):
+                        chosen = range(md["sysnum"])[systems]
+                    else:
+                        chosen = list(systems)
+
+                    ids = [ids[i] for i in chosen]
+
+                    if "signs" in md:
+                        md["signs"] = [md["signs"][i] for i in chosen]
+
+                fid = len(derived_md)
+
+                if link:
+                    os.link(source, derived.path / f"ens-{fid}.npy")
+                    source = f"ens-{fid}.npy"
+                else:
+                    source = os.path.relpath(source, derived.path)
+
+                md["iternum"] = t1 - t0
+                md["sysnum"] = len(ids)
+                md["view"] = {
+                    "source": source,
+                    "start": view["start"] + t0,
+                    "stop": view["start"] + t1,
+                    "systems": None if systems is None and
+                               view["systems"] is None
+                               else [int(i) for i in ids],
+                }
+
+                derived_md.append(md)
+
+            _write_metadata(derived.path, derived_md)
+
+        derived.load(mmap=True)
+
+        return derived
 
     def wipe(self):
         """Wipes all the data from the folder"""
 
-        with open(self.path / "metadata.json", "r") as mdfile:
+        self.flush()
 
-            metadata = json.load(mdfile)
+        with _FileLock(self.path / "metadata.lock"):
+
+            metadata = _read_metadata(self.path)
 
             for k in range(len(metadata)):
 
+                # Views without hard links have no files of their own
+                view = metadata[k].get("view")
+                if view is not None and view["source"] != f"ens-{k}.npy":
+                    continue
+
+                suffix = ".npz" if "replay" in metadata[k] else ".npy"
+
                 try:
 
-                    (self.path / f"ens-{k}.npy").unlink()
+                    (self.path / f"ens-{k}{suffix}").unlink()
 
                 except FileNotFoundError:
 
-                    warn(str(self.path / f"ens-{k}.npy") + " not found :(")
+                    warn(str(self.path / f"ens-{k}{suffix}") + " not found :(")
 
-        with open(self.path / "metadata.json", "w") as mdfile:
-
-            mdfile.write("[]")
+            _write_metadata(self.path, [])
 
         self.load()
 
     def add_ensemble(self, ens, save=False):
 
         self.ensembles.append(ens)
+        self.file_ids.append(None)
 
         if save:
+            self.save(len(self.ensembles) - 1)
+
+
+def _ensemble_metadata(ens):
+
+    md = {
+        "grid_shape": ens.grid_shape,
+        "sysnum": ens.sysnum,
+        "identical": ens.identical,
+        "p": ens.p,
+        "b": ens.b,
+        "h": ens.h,
+        "dynamics": ens.dynamics,
+        "iternum": ens.iternum
+    }
+
+    if getattr(ens, "replay", None) is not None:
+        md["replay"] = ens.replay
+
+    return md
+
+
+def _select_ids(metadata, select):
+    """Indices of the ensembles picked by select, see DataSet.load()"""
+
+    if select is None:
+        return [k for k, md in enumerate(metadata) if not md.get("pending")]
+    elif callable(select):
+        return [k for k, md in enumerate(metadata)
+                if not md.get("pending") and select(dict(md))]
+    else:
+        return list(select)
+
+
+def _open_view(path, view):
+    """
+    Memory-map the part of a data file which a view refers to
 
-            k = len(self.ensembles) - 1
+    path: Path -- folder of the DataSet holding the view
+    view: dict -- "view" entry of its metadata, see DataSet.derive()
+    """
 
-            with open(self.path / "metadata.json", "w") as outfile:
-                json.dump(self.get_metadata(), outfile, indent=4)
+    arr = np.load(path / view["source"], mmap_mode="r")
+    arr = arr[view["start"]:view["stop"]]
 
-            np.save(self.path / ("ens-" + str(k) + ".npy"), ens.asarray())
+    ids = view["systems"]
+
+    if ids is not None:
+
+        steps = np.diff(ids)
+
+        # Evenly spaced systems are a slice, which doesn't copy
+        if len(ids) > 1 and steps[0] > 0 and np.all(steps == steps[0]):
+            arr = arr[:, ids[0]:ids[-1] + 1:steps[0]]
+        elif len(ids) == 1:
+            arr = arr[:, ids[0]:ids[0] + 1]
+        else:
+            arr = arr[:, ids]
+
+    return arr
+
+
+def _read_metadata(path):
+    """Metadata of the DataSet in a folder, empty if there is none yet"""
+
+    try:
+        with open(path / "metadata.json", "r") as mdfile:
+            return json.load(mdfile)
+    except FileNotFoundError:
+        return []
+
+
+def _write_metadata(path, metadata):
+
+    _atomic_write(path / "metadata.json",
+                  lambda f: f.write(json.dumps(metadata, indent=4).encode()))
+
+
+def _atomic_write(target, write):
+    """
+    Write a file so that it is never seen half-written
+
+    The file is written to a temporary file next to it, which is then
+    renamed over the target. Renames within a folder are atomic, so
+    readers see either the old or the new file, even after a crash.
+
+    target: Path
+    write: callable -- takes a binary file object and writes to it
+    """
+
+    tmp = target.with_name(f".{target.name}.{socket.gethostname()}"
+                           f"-{os.getpid()}-{threading.get_ident()}.tmp")
+
+    try:
+        with open(tmp, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, target)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+class _FileLock:
+    """
+    Lock shared between processes, held while a lock file exists
+
+    The lock file is created with O_EXCL, which is atomic on local
+    filesystems and on NFSv3 and later, so this also works across nodes.
+    It contains the host and pid of the holder: a lock left behind by a
+    crashed process on the same host is broken, and a lock which can't
+    be acquired in timeout seconds raises TimeoutError rather than
+    waiting forever.
+    """
+
+    def __init__(self, path, timeout=60, poll=0.05):
+
+        self.path = Path(path)
+        self.timeout = timeout
+        self.poll = poll
+
+    def __enter__(self):
+
+        start = time.monotonic()
+
+        while True:
+
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if self._break_stale():
+                    continue
+                if time.monotonic() - start > self.timeout:
+                    raise TimeoutError(
+                        f"could not acquire {self.path} (held by "
+                        f"{self._holder() or 'unknown'}), delete it if "
+                        f"its holder has crashed")
+                time.sleep(self.poll)
+            else:
+                break
+
+        with os.fdopen(fd, "w") as f:
+            f.write(f"{socket.gethostname()} {os.getpid()}\n")
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.path.unlink()
+
+    def _holder(self, path=None):
+        """Contents of the lock file, "<host> <pid>", "" if unreadable"""
+
+        try:
+            with open(path or self.path, "r") as f:
+                return f.read().strip()
+        except OSError:
+            return ""
+
+    def _break_stale(self):
+        """
+        Remove the lock file if its holder is a dead process on this host
+
+        RETURNS: bool -- True if a stale lock was removed
+        """
+
+        holder = self._holder()
+
+        try:
+            host, pid = holder.split()
+            pid = int(pid)
+        except ValueError:
+            return False
+
+        if host != socket.gethostname() or _pid_alive(pid):
+            return False
+
+        # Renaming first means only one waiter removes it, and a fresh
+        # lock taken in the meantime is put back
+        stale = self.path.with_name(
+            f".{self.path.name}.{os.getpid()}-{threading.get_ident()}.stale")
+
+        try:
+            os.rename(self.path, stale)
+        except FileNotFoundError:
+            return False
+
+        if self._holder(stale) == holder:
+            warn(f"broke the lock {self.path} left by dead process {pid}")
+            stale.unlink()
+            return True
+
+        try:
+            os.link(stale, self.path)
+        except FileExistsError:
+            pass
+        stale.unlink()
+
+        return False
+
+
+def _pid_alive(pid):
+    """Whether a process with this pid exists on this host"""
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+class _Writer:
+    """
+    Background thread running the file writes of a DataSet in order
+
+    Writes are queued up to maxsize, after which submit() blocks. Once a
+    write fails, the rest are skipped and the error is raised from the
+    next submit() or flush().
+    """
+
+    def __init__(self, maxsize=2):
+
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def _work(self):
+
+        while True:
+
+            job = self.queue.get()
+
+            try:
+                if job is None:
+                    return
+                if self.error is None:
+                    func, args = job
+                    func(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("background write failed") from error
+
+    def submit(self, func, *args):
+
+        self._check()
+        self.queue.put((func, args))
+
+    def flush(self):
+
+        self.queue.join()
+        self._check()
+
+    def close(self):
+
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+
+class TrajectoryBuffer:
+    """
+    Growable, preallocated store of ensemble states over time
+
+    Behaves like a list of (sysnum, Nx, Ny)-states (len, indexing,
+    slicing, iteration, append) but keeps them in one contiguous array.
+    The capacity doubles whenever it runs out, so appending is amortised
+    O(1), and view(), slicing and trim() never copy.
+
+    [!] views are invalidated (left pointing to stale data) when the
+        buffer grows
+    """
+
+    def __init__(self, state_shape, dtype=simulator.SPIN_DTYPE, capacity=16):
+        """
+        state_shape: (int, int, int) -- (sysnum, Nx, Ny)
+        dtype: numpy dtype of the spins
+        capacity: int -- number of states to preallocate
+        """
+
+        self._data = np.empty((capacity,) + tuple(state_shape), dtype=dtype)
+        self._start = 0
+        self._stop = 0
+
+    @classmethod
+    def from_array(cls, arr):
+        """Wrap an existing (iternum, sysnum, Nx, Ny)-array without copying"""
+
+        buf = cls(arr.shape[1:], dtype=arr.dtype, capacity=0)
+        buf._data = arr
+        buf._stop = arr.shape[0]
+
+        return buf
+
+    @property
+    def dtype(self):
+        return self._data.dtype
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, key):
+        return self.view()[key]
+
+    def __iter__(self):
+        return iter(self.view())
+
+    def view(self):
+        """Zero-copy (iternum, sysnum, Nx, Ny)-array of the stored states"""
+
+        return self._data[self._start:self._stop]
+
+    def _grow(self, mincapacity):
+
+        capacity = max(2 * len(self), mincapacity, 16)
+        data = np.empty((capacity,) + self._data.shape[1:], dtype=self.dtype)
+        data[:len(self)] = self.view()
+
+        self._data = data
+        self._stop -= self._start
+        self._start = 0
+
+    def reserve(self, count):
+        """Make sure there is room for count more states without growing"""
+
+        if self._stop + count > self._data.shape[0]:
+            self._grow(len(self) + count)
+
+    def append(self, state):
+
+        self.reserve(1)
+        self._data[self._stop] = state
+        self._stop += 1
+
+    def claim(self, count):
+        """
+        Append count uninitialised states, to be written into directly
+
+        RETURNS: (count, sysnum, Nx, Ny)-array -- view of the new states
+        """
+
+        self.reserve(count)
+        self._stop += count
+
+        return self._data[self._stop - count:self._stop]
+
+    def trim(self, count):
+        """Forget the first count states, without copying"""
+
+        self._start = min(self._start + count, self._stop)
 
 
 class Ensemble:
     """Ensemble of states with similar init conditions and parameters"""
 
     def __init__(self, grid_shape, sysnum, p, b, h,
-                 identical=False, initialise=True, randflip=False):
+                 identical=False, initialise=True, randflip=False,
+                 dynamics="metropolis"):
         """
         grid_shape: (int, int)
         sysnum: int -- number of systems in the ensemble
         p, b, h: floats -- proportion of initial spins, 1/temp, applied field
         identical: bool -- whether the systems should be initialised identically
         initialise: bool -- set to False to manually initialise iternum and such
+        dynamics: "metropolis", "heatbath" OR "nfold",
+            see simulator.iterate()
         """
 
         if type(grid_shape) is int:
@@ -148,6 +832,7 @@ class Ensemble:
         self.identical = identical
         self.p = p
         self.randflip = randflip
+        self.dynamics = dynamics
 
         hs = np.asarray(h)
         self.hmode = ""
@@ -169,7 +854,7 @@ class Ensemble:
 
         elif len(hs.shape) == 2:
 
-            assert bs.shape == grid_shape
+            assert hs.shape == grid_shape
             self.hmode = "grid"
             self.h = h
             self.const_h = False
@@ -190,10 +875,33 @@ class Ensemble:
         self.const_b = True
         self.b = b
 
+        self.state = None
+
+        # Pending global spin flips of each system, see flip()
+        self.signs = None
+
+        # Use compiled kernels, see simulator.iterate(). Set to False
+        # for runs which must be reproducible from a seed, see replay
+        self.jit = None
+
+        self.observables = {
+            "magnetisation": thermo.magnetisation,
+            "square_mag": thermo.square_mag,
+            "energy": thermo.energy,
+        }
+
         if initialise:
             self.reset(regen_init=True)
 
-    def simulate(self, iternum, reset=True, regen_init=False, verbose=False):
+    def simulate(self, iternum, reset=True, regen_init=False, verbose=False,
+                 thin=1):
+        """
+        Simulate the ensemble, appending to the data
+
+        iternum: int -- number of iterations to add to the data
+        thin: int -- only record every thin-th iteration, so that
+            iternum * thin iterations are actually simulated
+        """
 
         if reset:
             self.reset(regen_init=regen_init)
@@ -203,24 +911,80 @@ class Ensemble:
         if verbose:
             bar = loadingbar.LoadingBar(iternum)
 
-        for k in range(iternum):
-            self.next()
+        self.iterations.reserve(iternum)
+
+        # Simulate in blocks, so the loading bar keeps moving
+        blocksize = max(iternum // 100, 1) if verbose else max(iternum, 1)
+
+        for start in range(0, iternum, blocksize):
+
+            count = min(blocksize, iternum - start)
+            self._simulate_block(count, thin)
+
             if verbose:
-                bar.print_next()
+                for k in range(count):
+                    bar.print_next()
+
+    def _simulate_block(self, iternum, thin):
+        """
+        Simulate and record iternum iterations with a single kernel call
 
-    def next(self):
+        See simulate(). Subclasses which need to act between iterations
+        can override this.
+        """
+
+        if self.state is None:
+            self.state = self._last_state()
+
+        sweepnum = iternum * thin
+
+        if self.hmode == "time" or self.hmode == "timegrid":
+            period = self.hs.shape[0]
+            h = self.hs[(self.hcount + np.arange(sweepnum)) % period]
+        else:
+            h = self.h
 
-        self.iterations.append(
-            simulator.iterate_ensemble(self.iterations[-1],
-                                       b=self.b, h=self.h,
-                                       const_h=self.const_h)
-        )
-        self.iternum += 1
+        simulator.sweeps(self.state, sweepnum, b=self.b, h=h,
+                         record_every=thin, dynamics=self.dynamics,
+                         jit=self.jit, out=self.iterations.claim(iternum))
+        self.iternum += iternum
+
+        if self.hmode == "time" or self.hmode == "timegrid":
+            self.hcount = (self.hcount + sweepnum) % period
+            self.h = self.hs[self.hcount]
+
+    def next(self, record=True):
+        """
+        Step the ensemble through one iteration
+
+        The working state self.state is updated in-place, and only copied
+        into the data if record is True.
+        """
+
+        if self.state is None:
+            self.state = self._last_state()
+
+        self._iterate(self.state)
+
+        if record:
+            self.iterations.append(self.state)
+            self.iternum += 1
 
         if self.hmode == "time" or self.hmode == "timegrid":
             self.hcount = (self.hcount + 1) % self.hs.shape[0]
             self.h = self.hs[self.hcount]
 
+    def _iterate(self, state):
+        """
+        Step an ensemble state through one iteration
+
+        [!] modifies state in-place
+        """
+
+        simulator.iterate_ensemble(state, b=self.b, h=self.h,
+                                   const_h=self.const_h, inplace=True,
+                                   dynamics=self.dynamics, jit=self.jit)
+
     def reset(self, regen_init=False):
         """
         Erase simulation data
@@ -234,30 +998,115 @@ class Ensemble:
                 self.grid_shape, self.sysnum, self.p,
                 self.identical)
 
-        self.iterations = [self.init_state]
+        self.iterations = TrajectoryBuffer(self.init_state.shape)
+        self.iterations.append(self.init_state)
         self.iternum = 1
         self.final_state = self.init_state
 
+        # Working state for the simulation, see next()
+        self.state = None
+        self.signs = None
+
         if self.randflip:
             self.do_randflip()
 
-    def ensemble_avg(self, func):
+    def register_observable(self, name, func):
+        """
+        Add an observable to be evaluated by measure()
+
+        func: callable -- takes a (..., Nx, Ny)-array of microstates and
+            returns a (...,)-array, like thermo.magnetisation
+        """
+
+        self.observables[name] = func
+
+    def iter_chunks(self, chunksize=256):
+        """
+        Iterate over the ensemble in blocks of consecutive time steps
+
+        The blocks are views, so for memory-mapped data (see DataSet.load)
+        only one block is read into memory at a time, which bounds the
+        memory used by analysing long runs.
+
+        RETURNS: generator of (<= chunksize, sysnum, Nx, Ny)-arrays
+        """
+
+        for t in range(0, self.iternum, chunksize):
+
+            chunk = self.iterations[t:t + chunksize]
+
+            if self.signs is not None:
+                chunk = chunk * self.signs[nwxs, :, nwxs, nwxs]
+
+            yield chunk
+
+    def measure(self, names=None, chunksize=256, moments=4):
+        """
+        Evaluate observables over the whole ensemble in one pass
+
+        Each observable is evaluated on entire blocks of time steps at
+        once, see iter_chunks(), and its statistics over the ensemble
+        are taken at every time step.
+
+        names: list of str OR None -- registered observables to evaluate,
+            defaults to all of them
+        moments: int -- highest raw moment to calculate
+
+        RETURNS: dict -- name: dict with entries
+            "mean": (iternum,)-array -- mean over the ensemble
+            "std": (iternum,)-array -- stdev over the ensemble, ddof=1
+            "moments": (moments, iternum)-array -- [k] is the (k+1)th
+                raw moment over the ensemble
+        """
+
+        if names is None:
+            names = list(self.observables)
+
+        results = {name: {"mean": [], "std": [], "moments": []}
+                   for name in names}
+
+        for block in self.iter_chunks(chunksize):
+
+            for name in names:
+
+                values = self.observables[name](block)  # (t, sysnum)
+                res = results[name]
+
+                # Powers of integer observables (e.g. energy) overflow
+                values = np.asarray(values, dtype=float)
+
+                res["mean"].append(np.mean(values, axis=1))
+                res["std"].append(np.std(values, axis=1, ddof=1))
+                res["moments"].append(np.stack(
+                    [np.mean(values**k, axis=1)
+                     for k in range(1, moments + 1)], axis=0))
+
+        for res in results.values():
+            res["mean"] = np.concatenate(res["mean"])
+            res["std"] = np.concatenate(res["std"])
+            res["moments"] = np.concatenate(res["moments"], axis=1)
+
+        return results
+
+    def ensemble_avg(self, func, chunksize=256):
         """
         Calculates avg of property across ensemble over time
 
-        func: callable -- takes a microstate
+        func: callable -- takes a (..., Nx, Ny)-array of microstates,
+            like thermo.magnetisation
         """
 
-        return [
-            np.mean([func(microstate) for microstate in ens_state])
-            for ens_state in self.iterations
-        ]
+        return np.concatenate([
+            np.mean(func(block), axis=1)
+            for block in self.iter_chunks(chunksize)
+        ])
 
-    def ensemble_stdev(self, func, std_kwargs=None):
+    def ensemble_stdev(self, func, std_kwargs=None, chunksize=256):
         """
         Calculates stdev of property across ensemble over time
 
-        func: callable -- must take a microstate
+        func: callable -- takes a (..., Nx, Ny)-array of microstates,
+            like thermo.magnetisation
         """
 
         if std_kwargs is None:
@@ -265,20 +1114,37 @@ class Ensemble:
 
         std_kwargs.setdefault("ddof", 1)
 
-        return [
-            np.std([func(microstate) for microstate in ens_state],
-                   **std_kwargs)
-            for ens_state in self.iterations
-        ]
+        return np.concatenate([
+            np.std(func(block), axis=1, **std_kwargs)
+            for block in self.iter_chunks(chunksize)
+        ])
 
     def asarray(self):
         """
         Get ensemble over time as array
 
+        This is a view of the ensemble data, not a copy: modifying it
+        modifies the ensemble. The exception is when flips are pending
+        (see flip()), which are applied to a copy.
+
         Indexing: (iternum, sysnum, Nx, Ny)
         """
 
-        return np.array(self.iterations)
+        if self.signs is not None:
+            return self.iterations.view() * self.signs[nwxs, :, nwxs, nwxs]
+
+        return self.iterations.view()
+
+    def _last_state(self):
+        """Copy of the last state, to carry on simulating from"""
+
+        # New states can't have flips pending, so apply the old ones
+        if self.signs is not None:
+            self.iterations = TrajectoryBuffer.from_array(self.asarray())
+            self.init_state = self.iterations[0]
+            self.signs = None
+
+        return np.copy(self.iterations[-1])
 
     def trim_init(self, trimcount):
         """
@@ -288,9 +1154,69 @@ class Ensemble:
         """
 
         self.iternum -= trimcount
-        self.iterations = self.iterations[trimcount:]
+        self.iterations.trim(trimcount)
         self.init_state = self.iterations[0]
 
+    def equilibrate(self, checktime=50, mintime=100, maxtime=5000,
+                    observables=None, batch=5, verbose=False):
+        """
+        Simulate until equilibrium is detected, then trim the relaxation
+
+        After every checktime iterations, the MSER rule (see thermo.mser)
+        is applied to the ensemble average of each observable. Once every
+        truncation point lies in the first half of the data, equilibrium
+        is declared and the data up to the latest truncation point is
+        removed. The detected relaxation time is stored in self.relaxtime.
+
+        mintime: int -- never declare equilibrium with less data than this
+        observables: list of callables -- take a (t, sysnum, Nx, Ny)-array
+            and return a (t, sysnum)-array. Defaults to energy and |M|
+        batch: int -- batch size passed on to thermo.mser
+
+        RETURNS: int -- relaxation time, OR None if maxtime was exceeded
+        """
+
+        if observables is None:
+            observables = [
+                thermo.energy,
+                lambda a: np.abs(thermo.magnetisation(a))
+            ]
+
+        def ens_avgs(frames):
+            arr = np.asarray(frames)
+            return [np.mean(func(arr), axis=1) for func in observables]
+
+        # Ensemble averages over time, only updated with new iterations
+        series = ens_avgs(self.asarray())
+
+        while True:
+
+            if self.iternum < maxtime:
+                self.simulate(checktime, reset=False)
+                new = ens_avgs(self.iterations[-checktime:])
+                series = [np.concatenate(pair) for pair in zip(series, new)]
+
+            relaxtime = max(thermo.mser(s, batch) for s in series)
+            equilibrated = (2 * relaxtime < self.iternum
+                            and self.iternum >= mintime)
+
+            if verbose:
+                print(f"{self.iternum} iterations: "
+                      f"relaxation time estimate {relaxtime}")
+
+            if equilibrated or self.iternum >= maxtime:
+                break
+
+        if not equilibrated:
+            warn(f"No equilibrium detected after {self.iternum} iterations")
+            self.relaxtime = None
+            return None
+
+        self.trim_init(relaxtime)
+        self.relaxtime = relaxtime
+
+        return relaxtime
+
     def do_randflip(self):
         """
         Randomly flip some members of the ensemble
@@ -298,13 +1224,242 @@ class Ensemble:
         Used to restore symmetry after spontaneous symmetry breaking
         """
 
-        sysnum, Nx, Ny = self.init_state.shape
+        self.flip(npr.randint(0, 2, size=self.sysnum) == 0)
+
+    def flip(self, systems=None, lazy=None):
+        """
+        Flip every spin of some systems, at all times
+
+        Done either in-place in one broadcast multiplication, or lazily:
+        the flips are kept in self.signs and applied by asarray() and
+        iter_chunks() on read. Lazy flips of ensembles in a DataSet can
+        be saved without rewriting their data, see DataSet.save_signs().
+
+        systems: bool (sysnum,)-array OR list of ints OR None -- systems
+            to flip, defaults to all of them
+        lazy: bool OR None -- defaults to lazy only if the data is
+            read-only, e.g.: memory-mapped
+        """
+
+        signs = np.ones(self.sysnum, dtype=simulator.SPIN_DTYPE)
+        signs[slice(None) if systems is None else systems] = -1
+
+        if self.signs is not None:
+            signs *= self.signs
+
+        if lazy is None:
+            lazy = not self.iterations.view().flags.writeable
+
+        if lazy:
+
+            self.signs = signs
+
+            # Rebuilt from the flipped data when simulating continues
+            self.state = None
+
+        else:
+
+            arr = self.iterations.view()
+            arr *= signs[nwxs, :, nwxs, nwxs]
+            self.signs = None
+
+            if self.state is not None:
+                self.state *= signs[:, nwxs, nwxs]
+
+    def _transform(self, func):
+        """
+        Apply a lattice symmetry to every state
+
+        Done in-place, one chunk of time steps at a time, or into a new
+        buffer if the data is read-only.
+
+        func: callable -- maps (t, sysnum, Nx, Ny)-arrays to new arrays
+        """
+
+        arr = self.iterations.view()
+
+        if arr.flags.writeable:
+            for t in range(0, self.iternum, 256):
+                arr[t:t + 256] = func(arr[t:t + 256])
+        else:
+            self.iterations = TrajectoryBuffer.from_array(func(arr))
+            self.init_state = self.iterations[0]
+
+        if self.state is not None:
+            self.state[...] = func(self.state[nwxs])[0]
+
+    def translate(self, dx, dy):
+        """
+        Shift every state by (dx, dy) sites, with periodic boundaries
+
+        Energies and magnetisations are unchanged, so the translated
+        ensemble is an equally valid sample, e.g.: for data augmentation.
+        """
+
+        if self.hmode in ("grid", "timegrid"):
+            raise ValueError("space-varying h breaks translation symmetry")
+
+        self._transform(lambda a: np.roll(a, (dx, dy), axis=(-2, -1)))
+
+    def reflect(self, axis):
+        """
+        Mirror every state along axis 0 (x) or 1 (y)
+
+        See translate()
+        """
+
+        if self.hmode in ("grid", "timegrid"):
+            raise ValueError("space-varying h breaks reflection symmetry")
+
+        self._transform(lambda a: np.flip(a, axis=axis - 2))
+
+
+class TemperingEnsemble(Ensemble):
+    """
+    Parallel tempering (replica exchange) ensemble
+
+    Replicas at a ladder of b values are simulated together and
+    periodically attempt to swap configurations with their neighbours
+    on the ladder, which lets low-temperature systems escape from
+    metastable domain-wall states.
+
+    Systems are stored replica-major: the systems at bs[i] occupy the
+    slice [i * sysnum_b : (i + 1) * sysnum_b] of the system axis.
+    """
+
+    def __init__(self, grid_shape, sysnum, p, bs, h, swap_interval=1,
+                 identical=False, initialise=True, randflip=False,
+                 dynamics="metropolis"):
+        """
+        grid_shape: (int, int)
+        sysnum: int -- number of systems at each value of b
+        p, h: floats -- proportion of initial spins, applied field
+        bs: float (bnum,)-array -- ladder of b values
+        swap_interval: int -- number of iterations between swap attempts
+        """
+
+        self.bs = np.asarray(bs, dtype=float)
+        self.bnum = len(self.bs)
+        self.sysnum_b = sysnum
+        self.swap_interval = swap_interval
+        self._h_init = h
+
+        # swap_attempts[i], swap_accepts[i] refer to pair (bs[i], bs[i+1])
+        self.swap_attempts = np.zeros(self.bnum - 1, dtype=int)
+        self.swap_accepts = np.zeros(self.bnum - 1, dtype=int)
+
+        super().__init__(grid_shape, self.bnum * sysnum, p, self.bs, h,
+                         identical=identical, initialise=initialise,
+                         randflip=randflip, dynamics=dynamics)
+
+    def _simulate_block(self, iternum, thin):
+
+        # Swaps happen between iterations, so step one at a time
+        for k in range(iternum):
+            for _ in range(thin - 1):
+                self.next(record=False)
+            self.next()
+
+    def _blocks(self, state):
+        """View of an ensemble state indexed by (b index, system, Nx, Ny)"""
+
+        return state.reshape(self.bnum, self.sysnum_b, *self.grid_shape)
+
+    def _iterate(self, state):
+
+        blocks = self._blocks(state)
+
+        for i, b in enumerate(self.bs):
+            simulator.iterate_ensemble(blocks[i], b=b, h=self.h,
+                                       const_h=self.const_h, inplace=True,
+                                       dynamics=self.dynamics, jit=self.jit)
+
+        self._sweepnum += 1
+
+        if self._sweepnum % self.swap_interval == 0:
+            self.attempt_swaps(state)
+
+    def reset(self, regen_init=False):
+
+        super().reset(regen_init=regen_init)
+
+        # replica_ids[i, s] is the original replica now at bs[i], system s
+        self.replica_ids = np.repeat(
+            np.arange(self.bnum)[:, nwxs], self.sysnum_b, axis=1)
+        self._swap_parity = 0
+        self._sweepnum = 0
+
+    def attempt_swaps(self, state=None):
+        """
+        Attempt configuration swaps between neighbouring b values
+
+        Even and odd pairs on the ladder are tried alternately. A swap
+        between bs[i] and bs[i+1] is accepted with probability
+            min(1, exp((bs[i] - bs[i+1]) * (E_i - E_{i+1})))
+        independently for each system.
+
+        state: (sysnum, Nx, Ny)-array -- defaults to the working state
+
+        [!] modifies state in-place
+        """
+
+        if state is None:
+            if self.state is None:
+                self.state = self._last_state()
+            state = self.state
+
+        blocks = self._blocks(state)
+        energies = thermo.energy(blocks, self.h)
+
+        for i in range(self._swap_parity, self.bnum - 1, 2):
+
+            delta = ((self.bs[i] - self.bs[i + 1])
+                     * (energies[i] - energies[i + 1]))
+            accept = npr.rand(self.sysnum_b) < np.exp(np.minimum(delta, 0))
+
+            # Boolean indexing makes copies, so the right-hand sides are
+            # evaluated before anything is overwritten
+            for arr in (blocks, self.replica_ids):
+                arr[i, accept], arr[i + 1, accept] = \
+                    arr[i + 1, accept], arr[i, accept]
+
+            self.swap_attempts[i] += self.sysnum_b
+            self.swap_accepts[i] += np.count_nonzero(accept)
+
+        self._swap_parity = 1 - self._swap_parity
+
+    def acceptance_rates(self):
+        """
+        Fraction of accepted swaps for each neighbouring pair of bs
+
+        RETURNS: float (bnum - 1,)-array
+        """
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.swap_accepts / self.swap_attempts
+
+    def get_ensemble(self, i):
+        """
+        Extract the trajectory at bs[i] as an ordinary Ensemble
+
+        The returned Ensemble holds copies of the data, so it can be
+        analysed or added to a DataSet like any other.
+        """
+
+        ens = Ensemble(self.grid_shape, self.sysnum_b, self.p, self.bs[i],
+                       self._h_init, identical=self.identical,
+                       initialise=False, dynamics=self.dynamics)
 
-        for s in range(sysnum):
+        arr = self.asarray().reshape(
+            self.iternum, self.bnum, self.sysnum_b, *self.grid_shape)
+        ens.iterations = TrajectoryBuffer.from_array(np.copy(arr[:, i]))
+        ens.iternum = self.iternum
+        ens.init_state = ens.iterations[0]
+        ens.final_state = ens.iterations[-1]
 
-            if npr.randint(0, 2) == 0:
+        return ens
 
-                for t in range(self.iternum):
+    def get_ensembles(self):
+        """Extract the trajectories at every b, see get_ensemble()"""
 
-                    state = self.iterations[t]
-                    state[s] *= -1
+        return [self.get_ensemble(i) for i in range(self.bnum)]
@@ -0,0 +1,300 @@
+"""
+Headless export of spin animations to video, GIF or image sequences
+
+Frames are turned into images directly, without matplotlib: spins are
+mapped to colours through a lookup table (see colour_table()), ensembles
+are tiled with plotter.mosaic(), and the images are encoded in worker
+threads, a chunk of frames at a time. numpy indexing and PIL encoding
+release the GIL, and unlike processes, threads don't re-import scripts
+without a main guard. Videos are piped to ffmpeg, which is found like
+matplotlib finds it (rcParams["animation.ffmpeg_path"]).
+
+The output format is picked from the file suffix:
+    .mp4, .mkv, .webm, .avi -- video, encoded by ffmpeg
+    .gif -- animated GIF
+    .png -- image sequence, written as <stem>-00000.png, <stem>-00001.png...
+"""
+
+import os
+import numpy as np
+import matplotlib as mpl
+import shutil
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from . import plotter, loadingbar
+
+
+VIDEO_SUFFIXES = (".mp4", ".mkv", ".webm", ".avi")
+
+
+def colour_table(cmap="binary", vmin=-1, vmax=1, background="white"):
+    """
+    RGB colours of the pixels of indices()
+
+    RETURNS: uint8 (3, 3)-array -- colours of spin down, background and
+        spin up, in that order
+    """
+
+    cmap = mpl.colormaps[cmap] if isinstance(cmap, str) else cmap
+    norm = mpl.colors.Normalize(vmin, vmax)
+
+    colours = [cmap(norm(-1)), mpl.colors.to_rgba(background), cmap(norm(1))]
+
+    return (np.array(colours)[:, :3] * 255).round().astype(np.uint8)
+
+
+def indices(frames, pad=1, scale=1):
+    """
+    Tile frames into images of colour indices, see colour_table()
+
+    Images are scaled up by repeating pixels, and padded with background
+    to even sizes, which video encoders need.
+
+    frames: (t, sysnum, Nx, Ny)-array
+    pad, scale: int -- pixels between systems, pixels per spin
+
+    RETURNS: uint8 (t, H, W)-array
+    """
+
+    tiles = plotter.mosaic(frames, pad=pad, fill=0)
+    images = (tiles + 1).astype(np.uint8)
+
+    if scale > 1:
+        images = np.repeat(np.repeat(images, scale, axis=-2), scale, axis=-1)
+
+    t, H, W = images.shape
+
+    if H % 2 or W % 2:
+        even = np.ones((t, H + H % 2, W + W % 2), dtype=np.uint8)
+        even[:, :H, :W] = images
+        images = even
+
+    return images
+
+
+def render(frames, table, pad=1, scale=1):
+    """
+    Turn frames into RGB images
+
+    RETURNS: uint8 (t, H, W, 3)-array
+    """
+
+    return table[indices(frames, pad, scale)]
+
+
+def _work(job):
+    """Render (and for image sequences, save) a chunk of frames"""
+
+    kind, frames, table, pad, scale, target, start = job
+
+    if kind == "video":
+        return render(frames, table, pad, scale).tobytes()
+
+    images = indices(frames, pad, scale)
+
+    if kind == "gif":
+        return images
+
+    from PIL import Image
+
+    palette = table.ravel().tolist()
+
+    for i, image in enumerate(images):
+        im = Image.fromarray(image)
+        im.putpalette(palette)
+        im.save(target.format(start + i))
+
+
+def _decimate(chunks, every):
+    """Keep every every-th frame of a stream of chunks"""
+
+    offset = 0
+
+    for chunk in chunks:
+
+        kept = chunk[(-offset) % every::every]
+        offset += chunk.shape[0]
+
+        if kept.shape[0] > 0:
+            yield kept
+
+
+def _open_video(filename, shape, fps):
+
+    ffmpeg = shutil.which(mpl.rcParams["animation.ffmpeg_path"])
+
+    if ffmpeg is None:
+        raise RuntimeError("ffmpeg not found, set "
+                           "rcParams['animation.ffmpeg_path'] or save as "
+                           ".gif or .png instead")
+
+    H, W = shape
+
+    return subprocess.Popen([
+        ffmpeg, "-y", "-loglevel", "error",
+        "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{W}x{H}",
+        "-r", str(fps), "-i", "-",
+        "-pix_fmt", "yuv420p", str(filename)
+    ], stdin=subprocess.PIPE)
+
+
+def save(chunks, filename, framenum=None, fps=20, every=1, pad=1, scale=None,
+         cmap="binary", threads=None, verbose=False):
+    """
+    Export frames to a video, GIF or image sequence
+
+    chunks: iterable of (t, sysnum, Nx, Ny)-arrays -- consecutive frames
+    filename: str OR Path -- the suffix picks the format, see the top
+    framenum: int OR None -- total number of frames, for the loading bar
+    fps: float -- frames per second of videos and GIFs
+    every: int -- only export every every-th frame
+    pad: int -- pixels between systems
+    scale: int OR None -- pixels per spin, by default large enough for
+        images of about 480 pixels
+    cmap: str OR Colormap -- see colour_table()
+    threads: int OR None -- number of worker threads, defaults to the
+        number of CPUs. 0 renders in the calling thread
+
+    RETURNS: int -- number of frames exported
+    """
+
+    filename = Path(filename)
+    suffix = filename.suffix.lower()
+
+    if suffix in VIDEO_SUFFIXES:
+        kind = "video"
+    elif suffix in (".gif", ".png"):
+        kind = suffix[1:]
+    else:
+        raise ValueError(f"can't export to {suffix} files")
+
+    table = colour_table(cmap)
+    target = str(filename.with_name(filename.stem + "-{:05d}.png"))
+
+    chunks = _decimate(iter(chunks), every)
+
+    if verbose and framenum is not None:
+        bar = loadingbar.LoadingBar(-(-framenum // every))
+    else:
+        bar = None
+
+    if threads is None:
+        threads = os.cpu_count()
+
+    pool = ThreadPoolExecutor(threads) if threads > 0 else None
+    maxpending = 2 * max(threads, 1)
+
+    pending = deque()
+    video = None
+    gif = []
+    count = 0
+
+    def finish(result, n):
+
+        if kind == "video":
+            video.stdin.write(result)
+        elif kind == "gif":
+            gif.extend(result)
+
+        if bar is not None:
+            for k in range(n):
+                bar.print_next()
+
+    try:
+
+        for chunk in chunks:
+
+            chunk = np.asarray(chunk)
+
+            if scale is None:
+                *_, sysnum, Nx, Ny = chunk.shape
+                side = int(np.ceil(np.sqrt(sysnum))) * (max(Nx, Ny) + pad)
+                scale = max(1, 480 // side)
+
+            if kind == "video" and video is None:
+                video = _open_video(
+                    filename, indices(chunk[:1], pad, scale).shape[1:], fps)
+
+            job = (kind, chunk, table, pad, scale, target, count)
+            count += chunk.shape[0]
+
+            # Keep a bounded number of chunks in flight, in order
+            if pool is None:
+                finish(_work(job), chunk.shape[0])
+            else:
+                pending.append((pool.submit(_work, job), chunk.shape[0]))
+                while len(pending) >= maxpending:
+                    future, n = pending.popleft()
+                    finish(future.result(), n)
+
+        while pending:
+            future, n = pending.popleft()
+            finish(future.result(), n)
+
+    finally:
+
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+        if video is not None:
+            try:
+                video.stdin.close()
+            except BrokenPipeError:
+                pass
+            video.wait()
+
+    # Only checked once rendering succeeded, so as not to hide its errors
+    if video is not None and video.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to write {filename}")
+
+    if kind == "gif" and gif:
+
+        from PIL import Image
+
+        palette = table.ravel().tolist()
+        images = []
+
+        for image in gif:
+            im = Image.fromarray(image)
+            im.putpalette(palette)
+            images.append(im)
+
+        images[0].save(filename, save_all=True, append_images=images[1:],
+                       duration=1000 / fps, loop=0)
+
+    return count
+
+
+def save_mosaic(ensemble, filename, pad=0.05, chunksize=64, **kwargs):
+    """
+    Export a datagen.Ensemble as a mosaic, see plotter.animate_mosaic()
+
+    Frames are read chunk by chunk, so this also works for memory-mapped
+    and replay ensembles.
+
+    pad: float -- gap between systems, as a fraction of their size
+    kwargs: passed on to save()
+    """
+
+    pad = int(np.ceil(pad * max(ensemble.grid_shape)))
+
+    return save(ensemble.iter_chunks(chunksize), filename,
+                framenum=ensemble.iternum, pad=pad, **kwargs)
+
+
+def save_spins(simulation, filename, chunksize=64, **kwargs):
+    """
+    Export a single simulation, see plotter.animate_spins()
+
+    simulation: (iternum, Nx, Ny)-array
+    kwargs: passed on to save()
+    """
+
+    iternum = simulation.shape[0]
+    chunks = (simulation[t:t + chunksize, np.newaxis]
+              for t in range(0, iternum, chunksize))
+
+    return save(chunks, filename, framenum=iternum, **kwargs)
@@ -83,7 +83,11 @@ def _anim_func_spins(spins, image):
 def animate_spins(simulation, axes, show=False, repeat=1,
                   resize=True, noticks=True, imshow_kwargs=None,
                   anim_kwargs=None):
-    """Create a FuncAnimation object based on a particular simulation"""
+    """
+    Create a FuncAnimation object based on a particular simulation
+
+    To export to a file, see export.save_spins()
+    """
 
     if anim_kwargs is None:
         anim_kwargs = {}
@@ -112,28 +116,138 @@ def animate_spins(simulation, axes, show=False, repeat=1,
     return anim
 
 
-def _anim_func_mosaic(frame, image_list, text, lbar):
+class LivePlotSink:
+    """
+    Sink for simulator.stream() which draws the spins as they come in
+
+    See the sinks module.
+    """
+
+    def __init__(self, axes, every=1, pause=0.001, imshow_kwargs=None):
+        """
+        axes: matplotlib Axes to draw on
+        every: int -- only redraw for every every-th state
+        pause: float -- seconds to pause for, to let the figure redraw
+        """
+
+        self.axes = axes
+        self.every = every
+        self.pause = pause
+        self.imshow_kwargs = imshow_kwargs
+
+        self.image = None
+        self.count = 0
+
+    def send(self, k, spins):
+
+        if self.count % self.every == 0:
+
+            if self.image is None:
+                self.image = plot_spins(spins, self.axes,
+                                        imshow_kwargs=self.imshow_kwargs)
+            else:
+                self.image.set_data(np.flip(spins.T, axis=0))
+
+            self.axes.set_title(str(k))
+            plt.pause(self.pause)
+
+        self.count += 1
+
+    def close(self):
+        pass
+
+
+def mosaic(frames, ncols=None, pad=1, fill=0, out=None):
+    """
+    Tile every system of an ensemble into a single image
+
+    The systems are laid out in columns of ncols, from the bottom left,
+    each oriented like plot_spins() draws it. Works on any number of
+    leading (e.g.: time) axes at once, with no Python loop over systems.
+
+    frames: (..., sysnum, Nx, Ny)-array
+    ncols: int OR None -- defaults to a square layout
+    pad: int -- number of pixels between systems
+    fill: float -- value of the pixels between and after the systems,
+        e.g.: nan to leave them blank with imshow()
+    out: (..., H, W)-array OR None -- to write into rather than allocate
+
+    RETURNS: (..., H, W)-array -- indexed by [row, column] for imshow()
+    """
+
+    *lead, sysnum, Nx, Ny = frames.shape
+    lead = tuple(lead)
+
+    if ncols is None:
+        ncols = int(np.ceil(np.sqrt(sysnum)))
+    nrows = -(-sysnum // ncols)
+
+    H = nrows * (Ny + pad) - pad
+    W = ncols * (Nx + pad) - pad
+
+    if out is None:
+        dtype = frames.dtype if float(fill).is_integer() else np.float32
+        out = np.empty(lead + (H, W), dtype=dtype)
+
+    # Indexed by [..., column, row from the bottom, y, x]
+    tiles = np.full(lead + (ncols * nrows, Ny + pad, Nx + pad), fill,
+                    dtype=out.dtype)
+    tiles[..., :sysnum, :Ny, :Nx] = np.flip(np.swapaxes(frames, -1, -2), -2)
+    tiles = tiles.reshape(lead + (ncols, nrows, Ny + pad, Nx + pad))
+
+    # Rows from the top, then y, then columns, then x
+    tiles = np.flip(tiles, axis=-3)
+    image = np.moveaxis(tiles, -4, -2).reshape(
+        lead + (nrows * (Ny + pad), ncols * (Nx + pad)))
+
+    out[...] = image[..., :H, :W]
+
+    return out
+
+
+def _iter_frames(ensemble):
+    """Every (sysnum, Nx, Ny)-state of an ensemble, read chunk by chunk"""
+
+    for chunk in ensemble.iter_chunks():
+        yield from chunk
+
+
+def _anim_func_mosaic(frame, image, buffer, text, lbar, mosaic_kwargs):
 
     t, ens_state = frame
 
-    for sys_state, image in zip(ens_state, image_list):
-        image.set_data(sys_state)
+    image.set_data(mosaic(ens_state, out=buffer, **mosaic_kwargs))
 
     if lbar is not None:
         lbar.print_next()
 
     if text is None:
-        return tuple(image_list)
+        return image,
     else:
         text.set_text(str(t))
-        return tuple(image_list) + (text,)
+        return image, text
 
 
 def animate_mosaic(ensemble, fig=None, timestamp=False, verbose=False,
                    pad=0.05, bbox=(0, 0, 1, 1),
                    show=False, imshow_kwargs=None, anim_kwargs=None,
                    saveas=None):
-    """Draw out a datagen.Ensemble as a pretty mosaic animation"""
+    """
+    Draw out a datagen.Ensemble as a pretty mosaic animation
+
+    The systems are tiled into one image per frame, see mosaic(), drawn
+    by a single imshow(). Frames are read from the ensemble as they are
+    drawn, so long runs (and replay.ReplayEnsemble) never need to be
+    loaded whole.
+
+    To export to a file without drawing through matplotlib, which is
+    much faster, see export.save_mosaic().
+
+    pad: float -- gap between systems, as a fraction of their size
+    bbox: (left, bottom, width, height) -- of the mosaic in the figure
+
+    RETURNS: fig, [axes], anim
+    """
 
     if anim_kwargs is None:
         anim_kwargs = {}
@@ -141,46 +255,35 @@ def animate_mosaic(ensemble, fig=None, timestamp=False, verbose=False,
     anim_kwargs.setdefault("interval", 50)
     anim_kwargs.setdefault("repeat_delay", 500)
 
-    sysnum = ensemble.sysnum
-    iternum = ensemble.iternum
-    N = int(np.ceil(np.sqrt(sysnum)))
-    ens_arr = ensemble.asarray()
-
-    if fig is None:
-        fig = plt.figure(figsize=(5, 5))
-
-    axes_list = []
-    image_list = []
+    if not imshow_kwargs:
+        kwa = {}
+    else:
+        kwa = imshow_kwargs
 
-    k = 0
+    kwa.setdefault("cmap", "binary")
+    kwa.setdefault("vmax", +1)
+    kwa.setdefault("vmin", -1)
+    kwa.setdefault("interpolation", "nearest")
 
-    for i in range(N):
-        for j in range(N):
+    iternum = ensemble.iternum
+    Nx, Ny = ensemble.grid_shape
 
-            if k < sysnum:
+    # Blank gaps between the systems
+    mosaic_kwargs = {"pad": int(np.ceil(pad * max(Nx, Ny))), "fill": np.nan}
 
-                # Create grid of axes
-                left, bottom, width, height = bbox
-                bounds = (
-                    (left + (i + pad) / N) * (width - pad / N),
-                    (bottom + (j + pad) / N) * (height - pad / N),
-                    ((1 - pad) / N) * (width - pad / N),
-                    ((1 - pad) / N) * (height - pad / N)
-                )
-                ax = fig.add_axes(bounds)
-                axes_list.append(ax)
+    first = mosaic(next(_iter_frames(ensemble)), **mosaic_kwargs)
+    buffer = np.empty_like(first)
 
-                # Plot out initial spins
-                init_spins = ens_arr[0, k, ...]
-                im = plot_spins(init_spins, axes=ax, resize=False,
-                                imshow_kwargs=imshow_kwargs)
-                image_list.append(im)
+    if fig is None:
+        fig = plt.figure(figsize=(5, 5))
 
-            k += 1
+    ax = fig.add_axes(bbox)
+    ax.set_axis_off()
+    image = ax.imshow(first, **kwa)
 
     if timestamp:
-        text = axes_list[0].text(0, 0, "", color=(1, 0, 0), weight="bold",
-                                 ha="left", va="top")
+        text = ax.text(0, 1, "", color=(1, 0, 0), weight="bold",
+                       ha="left", va="top", transform=ax.transAxes)
     else:
         text = None
 
@@ -191,9 +294,11 @@ def animate_mosaic(ensemble, fig=None, timestamp=False, verbose=False,
 
     anim = mpl.animation.FuncAnimation(
         fig, _anim_func_mosaic,
-        frames=tuple((t, ens_arr[t, ...]) for t in range(iternum)),
-        fargs=(image_list, text, lbar),
-        init_func=lambda: 0,
+        frames=lambda: enumerate(_iter_frames(ensemble)),
+        fargs=(image, buffer, text, lbar, mosaic_kwargs),
+        init_func=lambda: (),
+        save_count=iternum,
+        cache_frame_data=False,
         **anim_kwargs
     )
 
@@ -207,4 +312,4 @@ def animate_mosaic(ensemble, fig=None, timestamp=False, verbose=False,
         plt.figure(fig.number)
         plt.show()
 
-    return fig, axes_list, anim
+    return fig, [ax], anim
@@ -0,0 +1,352 @@
+"""
+Ensembles stored as seeds and keyframes, with frames regenerated on demand
+
+record() simulates an ensemble in segments of keyframe_every frames,
+reseeding numpy's random number generator at the start of every segment
+and keeping only the first state of each segment (the keyframe) and
+the observable series. Any frame can then be regenerated exactly by
+re-running its segment from the keyframe with the same seed, which is
+what ReplayEnsemble does, caching the most recently used segments.
+
+Replays are only exact with the same numpy and the Python kernels, so
+compiled kernels are never used here, see simulator.iterate().
+
+Replay ensembles are saved and loaded by datagen.DataSet like any other
+ensemble, as a small .npz file instead of the full .npy data.
+"""
+
+import numpy as np
+import numpy.random as npr
+from collections import OrderedDict
+
+from . import datagen, loadingbar
+
+
+nwxs = np.newaxis
+
+
+def _segment_seed(seed, i):
+    """Seed for segment i, derived from the seed of the whole run"""
+
+    return int(np.random.SeedSequence([seed, i]).generate_state(1)[0])
+
+
+def _new_ensemble(params, keyframe, hcount):
+    """Ensemble ready to simulate on from a keyframe, see record()"""
+
+    ens = datagen.Ensemble(**params, initialise=False)
+
+    ens.iterations = datagen.TrajectoryBuffer.from_array(
+        np.copy(keyframe[nwxs]))
+    ens.init_state = ens.iterations[0]
+    ens.iternum = 1
+    ens.final_state = ens.init_state
+    ens.jit = False
+
+    if ens.hmode == "time" or ens.hmode == "timegrid":
+        ens.hcount = hcount
+        ens.h = ens.hs[hcount]
+
+    return ens
+
+
+def record(ens, iternum, keyframe_every=100, seed=None, observables=None,
+           thin=1, verbose=False):
+    """
+    Simulate an ensemble, keeping only what is needed to replay it
+
+    The run starts from the last state of ens, which is simulated on but
+    keeps no more than its last state. The global numpy random state is
+    restored afterwards.
+
+    ens: datagen.Ensemble -- not a TemperingEnsemble
+    iternum: int -- number of frames, including the initial state
+    keyframe_every: int -- number of frames between keyframes. Bigger
+        means less storage, but more recompute for every access
+    seed: int OR None -- seed of the run, drawn at random if None
+    observables: dict OR None -- name: callable, maps (t, sysnum, Nx, Ny)
+        to (t, sysnum)-arrays, evaluated on every frame. Defaults to the
+        observables registered with ens
+    thin: int -- number of sweeps between frames, see Ensemble.simulate()
+
+    RETURNS: ReplayEnsemble
+    """
+
+    if isinstance(ens, datagen.TemperingEnsemble):
+        raise TypeError("tempering ensembles can't be replayed")
+    if iternum < 2:
+        raise ValueError("need at least 2 frames")
+
+    if seed is None:
+        seed = int(npr.randint(2**31))
+    if observables is None:
+        observables = ens.observables
+
+    params = _params(ens)
+    segnum = -(-(iternum - 1) // keyframe_every)
+
+    keyframes = []
+    hcounts = []
+    series = {name: [] for name in observables}
+
+    def measure(frames):
+        for name, func in observables.items():
+            series[name].append(func(frames))
+
+    # Start from a copy of the last state, with flips applied
+    ens.trim_init(ens.iternum - 1)
+    ens.iterations = datagen.TrajectoryBuffer.from_array(ens.asarray())
+    ens.init_state = ens.iterations[0]
+    ens.signs = None
+    ens.state = None
+    ens.jit = False
+
+    measure(ens.asarray())
+
+    if verbose:
+        bar = loadingbar.LoadingBar(segnum)
+
+    rand_state = npr.get_state()
+
+    try:
+
+        for i in range(segnum):
+
+            count = min(keyframe_every, iternum - 1 - i * keyframe_every)
+
+            keyframes.append(np.copy(ens.iterations[-1]))
+            hcounts.append(getattr(ens, "hcount", 0))
+
+            # Simulated in one block, exactly as replays will be
+            npr.seed(_segment_seed(seed, i))
+            ens.simulate(count, reset=False, thin=thin)
+
+            measure(ens.iterations[-count:])
+            ens.trim_init(count)
+
+            if verbose:
+                bar.print_next()
+
+    finally:
+        npr.set_state(rand_state)
+
+    replay = {"seed": seed, "keyframe_every": keyframe_every, "thin": thin}
+
+    return ReplayEnsemble(
+        params, replay, np.stack(keyframes, axis=0), np.array(hcounts),
+        {name: np.concatenate(values, axis=0)
+         for name, values in series.items()},
+        iternum, final_state=np.copy(ens.iterations[-1]))
+
+
+def _params(ens):
+    """Arguments to recreate an Ensemble like ens"""
+
+    if ens.hmode == "time" or ens.hmode == "timegrid":
+        h = ens.hs
+    else:
+        h = ens.h
+
+    return {"grid_shape": tuple(ens.grid_shape), "sysnum": ens.sysnum,
+            "p": ens.p, "b": ens.b, "h": h, "identical": ens.identical,
+            "dynamics": ens.dynamics}
+
+
+class _Frames:
+    """
+    Lazy list of the frames of a ReplayEnsemble
+
+    Supports len, iteration and indexing by ints or slices, like the
+    TrajectoryBuffer of an Ensemble.
+    """
+
+    def __init__(self, ens):
+        self.ens = ens
+
+    def __len__(self):
+        return self.ens.iternum
+
+    def __getitem__(self, key):
+
+        if isinstance(key, slice):
+            return self.ens.frames(*key.indices(self.ens.iternum)[:2])[
+                ::key.step]
+
+        if key < 0:
+            key += self.ens.iternum
+        if not 0 <= key < self.ens.iternum:
+            raise IndexError(f"frame {key} out of range")
+
+        return self.ens.frames(key, key + 1)[0]
+
+    def __iter__(self):
+
+        for chunk in self.ens.iter_chunks():
+            yield from chunk
+
+
+class ReplayEnsemble:
+    """
+    Read-only ensemble whose frames are regenerated from keyframes
+
+    Has the attributes of datagen.Ensemble which analysis and plotting
+    rely on (grid_shape, sysnum, b, h, iternum, iterations, asarray(),
+    iter_chunks()), plus the observable series recorded with the run.
+    """
+
+    def __init__(self, params, replay, keyframes, hcounts, series, iternum,
+                 final_state=None, cache_size=8):
+        """
+        See record(), which is how these should be made
+
+        cache_size: int -- number of regenerated segments to keep
+        """
+
+        self.params = params
+        self.replay = replay
+        self.keyframes = keyframes
+        self.hcounts = hcounts
+        self.series = series
+        self.iternum = iternum
+        self.final_state = final_state
+
+        self.grid_shape = params["grid_shape"]
+        self.sysnum = params["sysnum"]
+        self.identical = params["identical"]
+        self.p = params["p"]
+        self.b = params["b"]
+        self.dynamics = params["dynamics"]
+
+        # Time-varying fields are stored with the keyframes instead
+        self.h = params["h"] if np.ndim(params["h"]) == 0 else None
+
+        self.signs = None
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    @classmethod
+    def load(cls, filename, md, replay, iternum):
+        """Load from a file written by payload(), see datagen.DataSet"""
+
+        with np.load(filename) as data:
+
+            params = dict(md)
+            params["grid_shape"] = tuple(params["grid_shape"])
+            if "h" in data:
+                params["h"] = data["h"]
+
+            series = {key[len("series-"):]: data[key]
+                      for key in data.files if key.startswith("series-")}
+
+            return cls(params, replay, data["keyframes"], data["hcounts"],
+                       series, iternum, final_state=data["final_state"])
+
+    def payload(self):
+        """Arrays to save, RETURNS: dict -- name: array"""
+
+        arrays = {"keyframes": self.keyframes, "hcounts": self.hcounts,
+                  "final_state": self.final_state}
+
+        if self.h is None:
+            arrays["h"] = self.params["h"]
+
+        for name, values in self.series.items():
+            arrays["series-" + name] = values
+
+        return arrays
+
+    @property
+    def iterations(self):
+        return _Frames(self)
+
+    def segment(self, i):
+        """
+        Regenerate segment i: keyframe i and the frames after it
+
+        RETURNS: (<= keyframe_every + 1, sysnum, Nx, Ny)-array
+        """
+
+        if i in self._cache:
+            self._cache.move_to_end(i)
+            return self._cache[i]
+
+        every = self.replay["keyframe_every"]
+        count = min(every, self.iternum - 1 - i * every)
+
+        ens = _new_ensemble(self.params, self.keyframes[i], self.hcounts[i])
+
+        rand_state = npr.get_state()
+
+        try:
+            npr.seed(_segment_seed(self.replay["seed"], i))
+            ens.simulate(count, reset=False, thin=self.replay["thin"])
+        finally:
+            npr.set_state(rand_state)
+
+        frames = ens.asarray()
+        frames.flags.writeable = False
+
+        self._cache[i] = frames
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+        return frames
+
+    def frames(self, start, stop):
+        """
+        Regenerate frames start:stop
+
+        RETURNS: (stop - start, sysnum, Nx, Ny)-array
+        """
+
+        every = self.replay["keyframe_every"]
+        parts = []
+
+        t = start
+        while t < stop:
+
+            # Frame t is in segment i, at position t - i * every
+            i = min(t // every, len(self.keyframes) - 1)
+            seg = self.segment(i)
+            end = min(stop, i * every + seg.shape[0])
+
+            parts.append(seg[t - i * every:end - i * every])
+            t = end
+
+        if not parts:
+            return np.empty((0, self.sysnum) + tuple(self.grid_shape),
+                            dtype=self.keyframes.dtype)
+
+        return np.concatenate(parts, axis=0)
+
+    def iter_chunks(self, chunksize=None):
+        """
+        Iterate over the frames one segment at a time
+
+        chunksize: int OR None -- split segments into smaller chunks
+
+        RETURNS: generator of (<= chunksize, sysnum, Nx, Ny)-arrays
+        """
+
+        every = self.replay["keyframe_every"]
+        if chunksize is None:
+            chunksize = every
+
+        t = 0
+
+        while t < self.iternum:
+
+            # Keep chunks within segments, so each is regenerated once
+            stop = min(t + chunksize, self.iternum, (t // every + 1) * every)
+            yield self.frames(t, stop)
+            t = stop
+
+    def asarray(self):
+        """
+        Regenerate every frame
+
+        [!] this undoes the storage saving, prefer iter_chunks() or
+            iterations for long runs
+        """
+
+        return self.frames(0, self.iternum)
@@ -0,0 +1,311 @@
+"""Finite-size scaling analysis: Binder cumulants, peaks and fits"""
+
+import numpy as np
+
+from . import thermo
+
+
+# Per-system time averages which everything else is computed from,
+# in the order they are stored along the last axis of moment arrays
+MOMENTS = ("m2", "m4", "absm", "e", "e2")
+
+
+def moments(ensemble):
+    """
+    Per-system time averages of powers of magnetisation and energy
+
+    ensemble: datagen.Ensemble
+    RETURNS: (sysnum, len(MOMENTS))-array
+    """
+
+    arr = ensemble.asarray()
+    mags = thermo.magnetisation(arr).astype(float)
+    # Energies are integers, whose powers overflow for large grids
+    energies = thermo.energy(arr, ensemble.h).astype(float)
+
+    return np.stack([
+        np.mean(mags**2, axis=0),
+        np.mean(mags**4, axis=0),
+        np.mean(np.abs(mags), axis=0),
+        np.mean(energies, axis=0),
+        np.mean(energies**2, axis=0),
+    ], axis=-1)
+
+
+def collect(dataset):
+    """
+    Sort the ensembles of a dataset by N and compute their moments
+
+    Only square grids are used. Ensembles with the same N must all have
+    the same sysnum.
+
+    dataset: datagen.DataSet
+    RETURNS: dict -- N: (bs, moments), with bs a sorted (nb,)-array
+             and moments a (nb, sysnum, len(MOMENTS))-array
+    """
+
+    sorted_ens = {}
+
+    for ens in dataset.ensembles:
+
+        Nx, Ny = ens.grid_shape
+        if Nx == Ny:
+            sorted_ens.setdefault(Nx, []).append(ens)
+
+    data = {}
+
+    for N, ensembles in sorted(sorted_ens.items()):
+
+        ensembles.sort(key=lambda ens: ens.b)
+        bs = np.array([ens.b for ens in ensembles])
+        data[N] = bs, np.stack([moments(ens) for ens in ensembles], axis=0)
+
+    return data
+
+
+def observables(mmts, bs, N):
+    """
+    Binder cumulant, susceptibility and heat capacity from moments
+
+    The moments are averaged over the system axis first, so any extra
+    leading axes (e.g.: bootstrap samples) are carried through.
+
+    mmts: (..., nb, sysnum, len(MOMENTS))-array
+    bs: (nb,)-array
+    N: int
+    RETURNS: (..., nb)-arrays -- U, chi, C
+    """
+
+    m2, m4, absm, e, e2 = np.moveaxis(np.mean(mmts, axis=-2), -1, 0)
+
+    U = 1 - m4 / (3 * m2**2)
+    chi = bs * N**2 * (m2 - absm**2)
+    C = bs**2 * (e2 - e**2)
+
+    return U, chi, C
+
+
+def _interp_rows(xs, x, ys):
+    """Linearly interpolate ys(x) along the last axis, onto xs"""
+
+    ids = np.clip(np.searchsorted(x, xs) - 1, 0, len(x) - 2)
+    frac = (xs - x[ids]) / (x[ids + 1] - x[ids])
+
+    return ys[..., ids] * (1 - frac) + ys[..., ids + 1] * frac
+
+
+def find_peaks(xs, values):
+    """
+    Locate the maxima of each row by parabolic interpolation
+
+    Vectorised version of sweep.find_peak(), on a shared uniform or
+    non-uniform grid. Maxima at the edges of the grid are not refined.
+
+    xs: (n,)-array -- sorted
+    values: (..., n)-array
+    RETURNS: (...,)-arrays -- location and height of the peaks
+    """
+
+    xs = np.asarray(xs, dtype=float)
+    k = np.clip(np.argmax(values, axis=-1), 1, len(xs) - 2)
+    edge = np.argmax(values, axis=-1) != k
+
+    x0, x1, x2 = xs[k - 1], xs[k], xs[k + 1]
+    y0, y1, y2 = (np.take_along_axis(values, (k + d)[..., np.newaxis],
+                                     axis=-1)[..., 0]
+                  for d in (-1, 0, 1))
+
+    # Parabola through three points, in Newton form
+    d01 = (y1 - y0) / (x1 - x0)
+    d12 = (y2 - y1) / (x2 - x1)
+    a = (d12 - d01) / (x2 - x0)
+    b = d01 - a * (x0 + x1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        peaks = np.where(a < 0, -b / (2 * a), x1)
+
+    heights = y0 + (peaks - x0) * (d01 + a * (peaks - x1))
+
+    # Keep edge maxima where they are
+    kmax = np.argmax(values, axis=-1)
+    peaks = np.where(edge, xs[kmax], peaks)
+    heights = np.where(edge, np.max(values, axis=-1), heights)
+
+    return peaks, heights
+
+
+def find_crossings(xs, values):
+    """
+    Find where consecutive rows cross, by linear interpolation
+
+    Used to find the critical point from Binder cumulants at several N.
+    If a pair of rows never cross, the crossing is nan.
+
+    xs: (n,)-array -- sorted
+    values: (..., rows, n)-array
+    RETURNS: (..., rows - 1)-array
+    """
+
+    diffs = values[..., 1:, :] - values[..., :-1, :]
+    changes = np.sign(diffs[..., :-1]) * np.sign(diffs[..., 1:]) <= 0
+    found = np.any(changes, axis=-1)
+    k = np.argmax(changes, axis=-1)
+
+    d0 = np.take_along_axis(diffs, k[..., np.newaxis], axis=-1)[..., 0]
+    d1 = np.take_along_axis(diffs, (k + 1)[..., np.newaxis], axis=-1)[..., 0]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        frac = np.where(d0 == d1, 0, d0 / (d0 - d1))
+
+    crossings = xs[k] + frac * (xs[k + 1] - xs[k])
+
+    return np.where(found, crossings, np.nan)
+
+
+def fit_power(Ns, values):
+    """
+    Fit values = A N^p by least squares in log-log space
+
+    e.g.: the susceptibility peak scales with exponent gamma / nu
+
+    Ns: (n,)-array
+    values: (..., n)-array
+    RETURNS: (...,)-arrays -- p, A
+    """
+
+    logN = np.log(Ns)
+    logv = np.log(values)
+
+    slope = (np.mean(logN * logv, axis=-1) - np.mean(logN) *
+             np.mean(logv, axis=-1)) / np.var(logN)
+    intercept = np.mean(logv, axis=-1) - slope * np.mean(logN)
+
+    return slope, np.exp(intercept)
+
+
+def fit_critical(Ns, Tcs, nus=None):
+    """
+    Fit the finite-size scaling form Tc(N) = Tc(inf) + a N^(-1 / nu)
+
+    For each candidate nu the fit is linear in N^(-1 / nu), so nu is
+    found by scanning and keeping the best least-squares fit.
+
+    Ns: (n,)-array
+    Tcs: (..., n)-array
+    nus: (m,)-array OR None -- candidate values of nu,
+        defaults to 200 values in [0.5, 2]. Pass [1] to fix nu.
+    RETURNS: (...,)-arrays -- Tc(inf), a, nu
+    """
+
+    if nus is None:
+        nus = np.linspace(0.5, 2, 200)
+
+    Tcs = np.asarray(Tcs, dtype=float)
+
+    # Indexed by [nu, n]
+    xs = np.asarray(Ns, dtype=float)[np.newaxis, :] ** (
+        -1 / np.asarray(nus)[:, np.newaxis])
+    xbar = np.mean(xs, axis=-1)
+
+    # Broadcasting to (..., nu, n)
+    ys = Tcs[..., np.newaxis, :]
+    ybar = np.mean(ys, axis=-1)
+
+    a = (np.mean(xs * ys, axis=-1) - xbar * ybar) / np.var(xs, axis=-1)
+    Tc_inf = ybar - a * xbar
+    residuals = np.sum((ys - Tc_inf[..., np.newaxis]
+                        - a[..., np.newaxis] * xs)**2, axis=-1)
+
+    best = np.argmin(residuals, axis=-1)[..., np.newaxis]
+
+    return (np.take_along_axis(Tc_inf, best, axis=-1)[..., 0],
+            np.take_along_axis(a, best, axis=-1)[..., 0],
+            np.asarray(nus)[best[..., 0]])
+
+
+def analyse(data, nboot=200, points=400, nus=None):
+    """
+    Full finite-size scaling analysis with bootstrap errors
+
+    The systems of every ensemble are resampled with replacement nboot
+    times, and the whole analysis is repeated on each resample at once.
+    Peaks are located on the b values of each N, and the observables are
+    interpolated onto a common grid of b values for the crossings.
+
+    data: dict -- output of collect()
+    nboot: int -- number of bootstrap resamples
+    points: int -- size of the common b grid
+    nus: see fit_critical()
+
+    RETURNS: dict -- with keys
+        "Ns", "bs": the sizes and the common b grid
+        "U", "chi", "C": (nN, points)-arrays
+        "b_chi", "b_C": (nN,)-arrays, locations of the peaks
+        "chi_max", "C_max": (nN,)-arrays, heights of the peaks
+        "b_U": (nN - 1,)-array, Binder cumulant crossings of consecutive Ns
+        "Tc_chi", "Tc_C": Tc(inf) from extrapolating the peaks
+        "nu_chi", "nu_C": nu from the same fits
+        "gamma_nu": gamma / nu, from the scaling of chi_max
+    and for every key but "Ns" and "bs", an entry "<key>_err" with its
+    bootstrap standard error.
+    """
+
+    Ns = np.array(sorted(data))
+
+    # Common grid covering the range where all Ns have data
+    bmin = max(data[N][0][0] for N in Ns)
+    bmax = min(data[N][0][-1] for N in Ns)
+    bs = np.linspace(bmin, bmax, points)
+
+    # Index 0 of the bootstrap axis is the original sample
+    obs = []
+    peaks = {"b_chi": [], "chi_max": [], "b_C": [], "C_max": []}
+
+    for N in Ns:
+
+        Nbs, mmts = data[N]
+        sysnum = mmts.shape[-2]
+
+        ids = np.random.randint(0, sysnum, size=(nboot + 1, sysnum))
+        ids[0] = np.arange(sysnum)
+
+        resampled = mmts[:, ids, :]  # (nb, nboot + 1, sysnum, moments)
+        resampled = np.moveaxis(resampled, 1, 0)
+
+        U_N, chi_N, C_N = observables(resampled, Nbs, N)
+
+        # Peaks are found on each N's own b values: interpolating first
+        # would make the curves piecewise linear, pinning the peaks to
+        # the sampled bs
+        for name, values in (("chi", chi_N), ("C", C_N)):
+            b_peak, height = find_peaks(Nbs, values)
+            peaks["b_" + name].append(b_peak)
+            peaks[name + "_max"].append(height)
+
+        obs.append(np.stack([
+            _interp_rows(bs, Nbs, values) for values in (U_N, chi_N, C_N)
+        ], axis=0))
+
+    # Indexed by [observable, bootstrap, N, b]
+    U, chi, C = np.stack(obs, axis=2)
+
+    results = {"Ns": Ns, "bs": bs}
+    samples = {"U": U, "chi": chi, "C": C}
+
+    # Indexed by [bootstrap, N]
+    for key, values in peaks.items():
+        samples[key] = np.stack(values, axis=-1)
+
+    samples["b_U"] = find_crossings(bs, U)
+
+    samples["Tc_chi"], _, samples["nu_chi"] = fit_critical(
+        Ns, 1 / samples["b_chi"], nus)
+    samples["Tc_C"], _, samples["nu_C"] = fit_critical(
+        Ns, 1 / samples["b_C"], nus)
+    samples["gamma_nu"], _ = fit_power(Ns, samples["chi_max"])
+
+    for key, values in samples.items():
+        results[key] = values[0]
+        results[key + "_err"] = np.nanstd(values[1:], axis=0, ddof=1)
+
+    return results
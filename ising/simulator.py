@@ -1,14 +1,63 @@
 """Simulator for the 2D Ising model using a Metropolis method"""
 
+import os
 import numpy as np
 import numpy.random as npr
 from pathlib import Path
+from warnings import warn
 
-from . import loadingbar
+from . import loadingbar, thermo, nfold
 
 
 nwxs = np.newaxis
 
+# Spins are only ever -1 or +1, so they are stored as single bytes.
+# Anything summing them must upcast, see thermo._accumulator().
+SPIN_DTYPE = np.int8
+
+
+# Optional Numba-compiled kernels, loaded on first use by _get_jit().
+# Set the environment variable ISING_NO_JIT to never use them.
+_jit = None
+_jit_tried = False
+
+
+def _get_jit(jit=None):
+    """
+    Get the compiled kernels module, or None to use the Python kernels
+
+    jit: bool OR None -- whether to use compiled kernels. None means
+        use them if numba is available.
+    """
+
+    global _jit, _jit_tried
+
+    if jit is False:
+        return None
+
+    if not _jit_tried:
+
+        _jit_tried = True
+
+        if not os.environ.get("ISING_NO_JIT"):
+            try:
+                from . import _jit as jitmodule
+                _jit = jitmodule
+            except ImportError:
+                pass
+
+    if _jit is None and jit:
+        warn("numba is not available, falling back to Python kernels")
+
+    return _jit
+
+
+def _jit_grids(b, h, shape):
+    """Broadcast b and h to float (Nx, Ny)-arrays for the compiled kernels"""
+
+    return (np.broadcast_to(np.asarray(b, dtype=float), shape),
+            np.broadcast_to(np.asarray(h, dtype=float), shape))
+
 
 def new_grid(grid_shape, p=0.5):
     """
@@ -16,6 +65,8 @@ def new_grid(grid_shape, p=0.5):
 
     grid_shape: (int, int)
     p: float -- percentage of spin up
+
+    RETURNS: int8 (Nx, Ny)-array
     """
 
     assert 0 <= p <= 1
@@ -23,7 +74,7 @@ def new_grid(grid_shape, p=0.5):
     if type(grid_shape) is int:
         grid_shape = (grid_shape, grid_shape)
 
-    return 2 * (npr.rand(*grid_shape) > p) - 1
+    return (2 * (npr.rand(*grid_shape) > p) - 1).astype(SPIN_DTYPE)
 
 
 def new_ensemble(grid_shape, sysnum, p=0.5, identical=False, randflip=False):
@@ -34,7 +85,7 @@ def new_ensemble(grid_shape, sysnum, p=0.5, identical=False, randflip=False):
     sysnum: int -- number of independent systems in the ensemble
     p: float -- percentage of spin up
 
-    RETURNS: (sysnum, Nx, Ny)-array
+    RETURNS: int8 (sysnum, Nx, Ny)-array
     """
 
     assert 0 <= p <= 1
@@ -43,10 +94,10 @@ def new_ensemble(grid_shape, sysnum, p=0.5, identical=False, randflip=False):
         grid_shape = (grid_shape, grid_shape)
 
     if identical:
-        a = 2 * (npr.rand(*grid_shape) > p) - 1
+        a = (2 * (npr.rand(*grid_shape) > p) - 1).astype(SPIN_DTYPE)
         ret = np.repeat(a[nwxs, ...], sysnum, axis=0)
     else:
-        ret = 2 * (npr.rand(sysnum, *grid_shape) > p) - 1
+        ret = (2 * (npr.rand(sysnum, *grid_shape) > p) - 1).astype(SPIN_DTYPE)
 
     if randflip:
 
@@ -55,43 +106,174 @@ def new_ensemble(grid_shape, sysnum, p=0.5, identical=False, randflip=False):
     return ret
 
 
-def _rand_flip_spin(spins, b, h, Nx, Ny, const_h=True, const_b=True):
+def _check_dynamics(dynamics):
+
+    if dynamics not in ("metropolis", "heatbath", "nfold"):
+        raise ValueError(f"unknown dynamics {dynamics}")
+
+    return dynamics
+
+
+def _flip_table(b, h):
+    """
+    Metropolis flip probabilities for constant b and h
+
+    The energy change of flipping spin s depends only on s and on s times
+    the sum of its neighbours, so it can be looked up rather than
+    computed: table[(s + 1) // 2][(s * nn + 4) // 2]
     """
-    Helper function for iterate()
+
+    return [
+        [float(np.exp(-2 * b * (snn + s * h))) for snn in (-4, -2, 0, 2, 4)]
+        for s in (-1, 1)
+    ]
+
+
+def _sweep(spins, b, h, const_h=True, const_b=True, table=None,
+           sequential=False):
+    """
+    Attempt to flip spins.size randomly chosen spins, Metropolis-style
+
+    Helper function for iterate(). All random numbers for the sweep are
+    drawn up front, and the spins are worked on as nested lists, which
+    is much faster than indexing numpy arrays one element at a time.
+
+    table: list OR None -- output of _flip_table(b, h), if precomputed
+    sequential: bool -- visit every spin in order instead
 
     [!] modifies spins array in-place
     """
 
-    if not const_h:
-        h = h[i, j]
-    if not const_b:
-        b = b[i, j]
+    Nx, Ny = spins.shape
+    count = spins.size
+
+    if sequential:
+        iis = np.repeat(np.arange(Nx), Ny).tolist()
+        jjs = np.tile(np.arange(Ny), Nx).tolist()
+    else:
+        iis = npr.randint(0, Nx, size=count).tolist()
+        jjs = npr.randint(0, Ny, size=count).tolist()
+
+    rands = npr.rand(count).tolist()
+
+    grid = spins.tolist()
+    const = const_h and const_b and np.ndim(b) == 0 and np.ndim(h) == 0
+
+    if const:
+        if table is None:
+            table = _flip_table(b, h)
+    else:
+        bs = np.broadcast_to(b, spins.shape).tolist()
+        hs = np.broadcast_to(h, spins.shape).tolist()
+
+    for i, j, r in zip(iis, jjs, rands):
+
+        row = grid[i]
+        s = row[j]
+
+        nn = (grid[(i + 1) % Nx][j] + grid[i - 1][j] +
+              row[(j + 1) % Ny] + row[j - 1])
+
+        # Choose whether to flip it or not!
+        if const:
+            p = table[(s + 1) // 2][(s * nn + 4) // 2]
+        else:
+            p = np.exp(-2 * bs[i][j] * (nn + hs[i][j]) * s)
+
+        if p > r:
+            row[j] = -s
+
+    spins[...] = grid
+
+
+_sublattice_cache = {}
+
+
+def sublattices(Nx, Ny):
+    """
+    Split a periodic grid into sublattices with no neighbours in common
+
+    Even grids are split like a checkerboard. If a side is odd, its last
+    row/column gets a colour of its own, and three colours are needed.
+    All the spins of a sublattice can then be updated at the same time.
+
+    RETURNS: bool (colours, Nx, Ny)-array -- one mask per sublattice
+    """
+
+    if (Nx, Ny) not in _sublattice_cache:
+
+        ci = np.arange(Nx) % 2
+        cj = np.arange(Ny) % 2
+
+        if Nx % 2 == 0 and Ny % 2 == 0:
+            colours = 2
+        else:
+            colours = 3
+            if Nx % 2 == 1:
+                ci[-1] = 2
+            if Ny % 2 == 1:
+                cj[-1] = 2
+
+        colour = (ci[:, nwxs] + cj[nwxs, :]) % colours
+        _sublattice_cache[Nx, Ny] = np.stack(
+            [colour == c for c in range(colours)], axis=0)
+
+    return _sublattice_cache[Nx, Ny]
+
+
+def _heatbath_sweep(ensemble, b, h):
+    """
+    Heat-bath (Glauber) update of every spin, one sublattice at a time
+
+    Each spin is set up with probability 1 / (1 + exp(-2b(nn + h))),
+    regardless of its current value. The probabilities are looked up in
+    a table when b and h are constant.
+
+    ensemble: (..., Nx, Ny)-array
+    b, h: float OR (Nx, Ny)-array
+
+    [!] modifies ensemble array in-place
+    """
+
+    Nx, Ny = ensemble.shape[-2:]
+    nn = np.empty_like(ensemble)
+    const = np.ndim(b) == 0 and np.ndim(h) == 0
+
+    if const:
+        # indexed by (nn + 4) // 2
+        table = 1 / (1 + np.exp(-2 * b * (np.arange(-4, 5, 2) + h)))
+    else:
+        b = np.broadcast_to(b, (Nx, Ny))
+        h = np.broadcast_to(h, (Nx, Ny))
+
+    for mask in sublattices(Nx, Ny):
 
-    # Pick out one random spin
-    i = npr.randint(0, Nx)
-    j = npr.randint(0, Ny)
+        thermo.neighbour_sum(ensemble, out=nn)
+        nn_sub = nn[..., mask]
 
-    # Calculate Delta E
-    dE = (
-        spins[(i + 1) % Nx, j] +
-        spins[i - 1, j] +
-        spins[i, (j + 1) % Ny] +
-        spins[i, j - 1] +
-        h
-    ) * spins[i, j]
+        if const:
+            probs = table[(nn_sub + 4) // 2]
+        else:
+            probs = 1 / (1 + np.exp(-2 * b[mask] * (nn_sub + h[mask])))
 
-    # Choose whether to flip it or not!
-    if np.exp(-2 * b * dE) > npr.rand():
-        spins[i, j] *= -1
+        ups = npr.rand(*probs.shape) < probs
+        ensemble[..., mask] = 2 * ups - 1
 
 
-def iterate(spins, b=1, h=0, inplace=False, const_h=True, const_b=True):
+def iterate(spins, b=1, h=0, inplace=False, const_h=True, const_b=True,
+            sequential=False, jit=None, dynamics="metropolis"):
     """
     Step through one iteration on the spins.
 
     spins: int (Nx, Ny)-array
     b: float -- kinetic/temperature parameter, b = J/kT
     h: float -- field parameter, h = muH/J
+    sequential: bool -- visit the spins in order rather than at random
+    jit: bool OR None -- use the compiled kernels? None: if available
+    dynamics: "metropolis" OR "heatbath" OR "nfold" -- heat-bath
+        dynamics always update whole sublattices at once, see
+        sublattices(). "nfold" is rejection-free Metropolis with the
+        same time axis (see the nfold module), needing uniform b and h.
 
     RETURNS: int (Nx, Ny)-array
     """
@@ -101,71 +283,207 @@ def iterate(spins, b=1, h=0, inplace=False, const_h=True, const_b=True):
         # of the spins grid.
         spins = np.copy(spins)
 
-    Nx, Ny = spins.shape
+    jitmodule = _get_jit(jit)
+
+    dynamics = _check_dynamics(dynamics)
 
-    for k in range(spins.size):
-        _rand_flip_spin(spins, b, h, Nx, Ny, const_h, const_b)
+    if dynamics == "heatbath":
+        _heatbath_sweep(spins, b, h)
+    elif dynamics == "nfold":
+        nfold.NFold(spins).sweep(b, h)
+    elif jitmodule is not None:
+        jitmodule.sweep(spins, *_jit_grids(b, h, spins.shape), sequential)
+    else:
+        _sweep(spins, b, h, const_h, const_b, sequential=sequential)
 
     return spins
 
 
-def iterate_ensemble(ensemble, b=1, h=0, const_h=True, const_b=True):
+def iterate_ensemble(ensemble, b=1, h=0, const_h=True, const_b=True,
+                     inplace=False, sequential=False, jit=None,
+                     dynamics="metropolis"):
     """
     Step through one iteration on an ensemble.
+
+    inplace: bool -- modify ensemble in-place rather than a copy
+    sequential, jit, dynamics: see iterate(). The compiled kernels sweep
+        the systems in parallel.
     """
 
-    ensemble = np.copy(ensemble)
+    if not inplace:
+        ensemble = np.copy(ensemble)
+
+    dynamics = _check_dynamics(dynamics)
+
+    if dynamics == "heatbath":
+        _heatbath_sweep(ensemble, b, h)
+        return ensemble
+
+    if dynamics == "nfold":
+        for spins in ensemble:
+            nfold.NFold(spins).sweep(b, h)
+        return ensemble
+
+    jitmodule = _get_jit(jit)
 
-    sysnum = ensemble.shape[0]
+    if jitmodule is not None:
+        jitmodule.sweep_ensemble(
+            ensemble, *_jit_grids(b, h, ensemble.shape[1:]), sequential)
+        return ensemble
 
-    for k in range(sysnum):
-        iterate(ensemble[k], b, h, inplace=True,
-                const_h=const_h, const_b=const_b)
+    table = _flip_table(b, h) if const_h and const_b else None
+
+    for spins in ensemble:
+        _sweep(spins, b, h, const_h, const_b, table, sequential)
 
     return ensemble
 
 
+def sweeps(ensemble, sweepnum, b=1, h=0, record_every=1,
+           observables=None, out=None, sequential=False, jit=None,
+           dynamics="metropolis"):
+    """
+    Run many iterations on an ensemble in a single call
+
+    Only every record_every-th state is kept, or only the observables
+    evaluated on it, so nothing else needs to return to the caller
+    between iterations.
+
+    ensemble: int (sysnum, Nx, Ny)-array -- modified in-place
+    sweepnum: int -- number of iterations
+    b: float OR (Nx, Ny)-array
+    h: float OR (Nx, Ny)-array, or a field schedule with one value per
+        iteration: (sweepnum,)- OR (sweepnum, Nx, Ny)-array
+    record_every: int
+    observables: dict OR None -- name: callable, taking a
+        (sysnum, Nx, Ny)-array and returning a (sysnum,)-array
+    out: (sweepnum // record_every, sysnum, Nx, Ny)-array OR None --
+        where to record the states, e.g.: a slice of a preallocated buffer
+    sequential, jit, dynamics: see iterate()
+
+    RETURNS: (sweepnum // record_every, sysnum, Nx, Ny)-array of states
+        OR if observables are given, dict -- name: (sweepnum //
+        record_every, sysnum)-array
+    """
+
+    sysnum, Nx, Ny = ensemble.shape
+    framenum = sweepnum // record_every
+
+    h = np.asarray(h)
+    schedule = h.ndim in (1, 3)
+    const_b = np.ndim(b) == 0
+    const_h = h.ndim in (0, 1)
+
+    if observables is None:
+        if out is None:
+            out = np.empty((framenum, sysnum, Nx, Ny), dtype=ensemble.dtype)
+        results = out
+    else:
+        results = {name: np.empty((framenum, sysnum))
+                   for name in observables}
+
+    jitmodule = _get_jit(jit)
+    dynamics = _check_dynamics(dynamics)
+
+    # The n-fold way class bookkeeping is kept up for the whole run
+    if dynamics == "nfold":
+        nfolds = [nfold.NFold(spins) for spins in ensemble]
+
+    # With no schedule, one lookup table does for the whole run
+    table = (_flip_table(b, h) if const_b and const_h and not schedule
+             else None)
+
+    for k in range(sweepnum):
+
+        hk = h[k] if schedule else h
+
+        if dynamics == "heatbath":
+
+            _heatbath_sweep(ensemble, b, hk)
+
+        elif dynamics == "nfold":
+
+            probs = nfold.flip_probs(b, hk)
+            for nf in nfolds:
+                nf.advance(nf.size, probs)
+
+        elif jitmodule is not None:
+
+            jitmodule.sweep_ensemble(
+                ensemble, *_jit_grids(b, hk, (Nx, Ny)), sequential)
+
+        else:
+
+            tk = (_flip_table(b, hk) if table is None and const_b
+                  and const_h else table)
+
+            for spins in ensemble:
+                _sweep(spins, b, hk, const_h, const_b, tk, sequential)
+
+        if (k + 1) % record_every == 0:
+
+            frame = (k + 1) // record_every - 1
+
+            if observables is None:
+                results[frame] = ensemble
+            else:
+                for name, func in observables.items():
+                    results[name][frame] = func(ensemble)
+
+    return results
+
+
 def _cast(a, output_shape):
-    """Helper function for run()"""
+    """Helper function for run() and stream()"""
 
     iternum, Nx, Ny = output_shape
-    tp = type(a)
 
-    if tp is np.ndarray:
+    if isinstance(a, (int, float, np.number)):
+
+        return np.broadcast_to(a, output_shape)
+
+    elif isinstance(a, np.ndarray):
 
         # Numpy broadcasting works from right to left in indices.
 
         if a.shape == (iternum,):
             return np.broadcast_to(a[:, nwxs, nwxs], output_shape)
-        elif a.shape == (Nx, Ny) or a.shape == (1,):
+        elif a.shape in ((Nx, Ny), (1,), (), output_shape):
             return np.broadcast_to(a, output_shape)
 
-    elif tp == int or tp == float:
+    raise ValueError(f"Can't cast this type {type(a)} to {output_shape}:\n{a}")
 
-        return np.broadcast_to(a, output_shape)
 
-    else:
+def _is_uniform(a, iternum):
+    """Whether a parameter passed to _cast() is the same over the grid"""
 
-        raise ValueError(f"Can't cast this type {tp} to {output_shape}:\n{a}")
+    return np.ndim(a) == 0 or np.shape(a) in ((iternum,), (1,))
 
 
-def run(init_spins, iternum, b=1, h=0, verbose=False, filename=None):
+def stream(init_spins, iternum, b=1, h=0, record_every=1, observables=None,
+           dynamics="metropolis", jit=None):
     """
-    Run a simulation and return it as an array indexed over time and space
+    Run a simulation, yielding states as they are produced
 
-    init_spins: int (Nx, Ny)-array
-    iternum: int -- number of iterations
-    filename: str OR Path OR None -- if None, do not save to file
+    Generator version of run(): nothing is stored, so the length of the
+    run is not limited by memory. Compose with the sinks module to save,
+    plot or analyse the states on the fly.
+
+    init_spins: int (Nx, Ny)-array -- not modified
+    iternum: int -- number of iterations, including the initial state
     b, h: float (Nx, Ny)- OR (iternum,)- OR (iternum, Nx, Ny)- array OR float
         -- accepts space/time varying arrays
-
-    RETURNS simulation: int (iternum, Nx, Ny)-array
+    record_every: int -- only yield every record_every-th state
+    observables: dict OR None -- name: callable, taking a (Nx, Ny)-array.
+        If given, the observables are yielded rather than the states
+    dynamics, jit: see iterate()
+
+    YIELDS: (k, spins) -- k is the iteration number, starting from 0 for
+                the initial state. spins is the working (Nx, Ny)-array,
+                which the next iterations modify: copy it to keep it
+            OR (k, dict) -- name: value, if observables are given
     """
 
-    if verbose:
-        bar = loadingbar.LoadingBar(iternum - 1)
-
-    # Useful throughout the function
     Nx, Ny = init_spins.shape
     output_shape = (iternum, Nx, Ny)
 
@@ -173,28 +491,61 @@ def run(init_spins, iternum, b=1, h=0, verbose=False, filename=None):
     bs = _cast(b, output_shape)
     hs = _cast(h, output_shape)
 
-    # Actually calculate simulation
+    # Uniform parameters are passed on as floats, for the fast kernels
+    b_uniform = _is_uniform(b, iternum)
+    h_uniform = _is_uniform(h, iternum)
+
+    spins = np.array(init_spins, dtype=SPIN_DTYPE)
+
+    for k in range(iternum):
+
+        if k > 0:
+            iterate(spins,
+                    bs[k, 0, 0] if b_uniform else bs[k],
+                    hs[k, 0, 0] if h_uniform else hs[k],
+                    inplace=True, dynamics=dynamics, jit=jit)
+
+        if k % record_every == 0:
+
+            if observables is None:
+                yield k, spins
+            else:
+                yield k, {name: func(spins)
+                          for name, func in observables.items()}
+
+
+def run(init_spins, iternum, b=1, h=0, verbose=False, filename=None,
+        dynamics="metropolis"):
+    """
+    Run a simulation and return it as an array indexed over time and space
+
+    init_spins: int (Nx, Ny)-array
+    iternum: int -- number of iterations
+    filename: str OR Path OR None -- if None, do not save to file
+    b, h: float (Nx, Ny)- OR (iternum,)- OR (iternum, Nx, Ny)- array OR float
+        -- accepts space/time varying arrays
+    dynamics: "metropolis", "heatbath" OR "nfold", see iterate()
+
+    RETURNS simulation: int8 (iternum, Nx, Ny)-array
+    """
 
     if verbose:
+        bar = loadingbar.LoadingBar(iternum - 1)
         print(f"Running simulation, {iternum} iterations")
 
-    # Initial state
-    simulation = np.empty(output_shape)
-    spins = init_spins
-    simulation[0] = spins
+    simulation = np.empty((iternum,) + init_spins.shape, dtype=SPIN_DTYPE)
 
-    # Step through simulation
-    for k in range(1, iternum):
+    for k, spins in stream(init_spins, iternum, b, h, dynamics=dynamics):
 
-        if verbose:
+        if verbose and k > 0:
             bar.print_next()
 
-        spins = iterate(spins, bs[k], hs[k])
         simulation[k] = spins
 
     # If a filename is given, save it to that file
     if filename is not None:
 
+        filename = str(filename)
         if filename.endswith(".npy"):
             filename = filename[:-4]
 
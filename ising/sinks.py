@@ -0,0 +1,135 @@
+"""
+Consumers for simulator.stream(), to handle states as they are produced
+
+Every sink has send(k, item), called with each (k, item) pair yielded by
+the stream, and close(), called once the stream is exhausted. Use
+drain() to feed one stream to several sinks at once, e.g.:
+
+    sinks.drain(simulator.stream(spins, 10000, b=0.44),
+                sinks.NpySink("run.npy", 10000, spins.shape),
+                sinks.StatsSink({"m": thermo.magnetisation}))
+"""
+
+import numpy as np
+from pathlib import Path
+
+from . import convergence, simulator
+
+
+def drain(stream, *sinks):
+    """
+    Feed every item of a stream to every sink, then close the sinks
+
+    RETURNS: tuple -- the sinks
+    """
+
+    try:
+        for k, item in stream:
+            for sink in sinks:
+                sink.send(k, item)
+    finally:
+        for sink in sinks:
+            sink.close()
+
+    return sinks
+
+
+class NpySink:
+    """
+    Write states to a .npy file in chunks
+
+    The file is memory-mapped and the states are collected into a
+    chunk-sized buffer, which is written out whenever it fills up.
+    """
+
+    def __init__(self, filename, framenum, grid_shape,
+                 dtype=simulator.SPIN_DTYPE, chunksize=100):
+        """
+        filename: str OR Path
+        framenum: int -- number of states which will be sent
+        grid_shape: (int, int)
+        """
+
+        self.filename = Path(filename).with_suffix(".npy")
+        self.file = np.lib.format.open_memmap(
+            self.filename, mode="w+", dtype=dtype,
+            shape=(framenum,) + tuple(grid_shape))
+
+        self.buffer = np.empty((chunksize,) + tuple(grid_shape), dtype=dtype)
+        self.buffered = 0
+        self.written = 0
+
+    def send(self, k, spins):
+
+        self.buffer[self.buffered] = spins
+        self.buffered += 1
+
+        if self.buffered == self.buffer.shape[0]:
+            self.flush()
+
+    def flush(self):
+
+        end = self.written + self.buffered
+        self.file[self.written:end] = self.buffer[:self.buffered]
+        self.file.flush()
+
+        self.written = end
+        self.buffered = 0
+
+    def close(self):
+
+        self.flush()
+        del self.file
+
+
+class StatsSink:
+    """
+    Keep running statistics of observables, see convergence.RunningStats
+
+    Accepts either states, on which the observables are evaluated, or
+    the dicts of values yielded by stream(observables=...).
+    """
+
+    def __init__(self, observables=None, maxlag=50, batch=100):
+        """
+        observables: dict OR None -- name: callable, taking a state.
+            Not needed if the stream yields observables already
+        batch: int -- number of values to collect before each update
+        """
+
+        self.observables = observables
+        self.maxlag = maxlag
+        self.batch = batch
+
+        self.stats = {}
+        self._pending = {}
+
+    def send(self, k, item):
+
+        if isinstance(item, dict):
+            values = item
+        else:
+            values = {name: func(item)
+                      for name, func in self.observables.items()}
+
+        for name, value in values.items():
+
+            if name not in self.stats:
+                self.stats[name] = convergence.RunningStats(self.maxlag)
+                self._pending[name] = []
+
+            self._pending[name].append(value)
+
+            if len(self._pending[name]) >= self.batch:
+                self.flush(name)
+
+    def flush(self, name):
+
+        if self._pending[name]:
+            self.stats[name].update(np.array(self._pending[name]))
+            self._pending[name] = []
+
+    def close(self):
+
+        for name in self.stats:
+            self.flush(name)
@@ -0,0 +1,157 @@
+"""Adaptive refinement of parameter sweeps over b (temperature)"""
+
+import numpy as np
+
+
+def _curvatures(xs, ys):
+    """
+    Estimate |f''| at every point of a non-uniform grid
+
+    The end points take the value of their neighbour.
+
+    xs: (n,)-array
+    ys: (n, ...)-array
+    RETURNS: (n, ...)-array
+    """
+
+    curvs = np.zeros(ys.shape)
+
+    if len(xs) < 3:
+        return curvs
+
+    h1 = np.diff(xs)[:-1].reshape((-1,) + (1,) * (ys.ndim - 1))
+    h2 = np.diff(xs)[1:].reshape((-1,) + (1,) * (ys.ndim - 1))
+    d1 = (ys[1:-1] - ys[:-2]) / h1
+    d2 = (ys[2:] - ys[1:-1]) / h2
+
+    curvs[1:-1] = np.abs(2 * (d2 - d1) / (h1 + h2))
+    curvs[0] = curvs[1]
+    curvs[-1] = curvs[-2]
+
+    return curvs
+
+
+def interval_scores(bs, ests, errs):
+    """
+    Score every interval between neighbouring grid points for refinement
+
+    The score of an interval is an estimate of the error made by linearly
+    interpolating across it, h^2 |f''| / 8, plus the mean statistical
+    error at its ends. If there are several observables, each is
+    normalised by its range over the grid and the scores are summed.
+
+    bs: (n,)-array -- sorted
+    ests, errs: (n,)- or (n, k)-arrays
+    RETURNS: (n - 1,)-array
+    """
+
+    ests = np.asarray(ests, dtype=float).reshape(len(bs), -1)
+    errs = np.asarray(errs, dtype=float).reshape(len(bs), -1)
+
+    scale = np.ptp(ests, axis=0)
+    scale[scale == 0] = 1
+
+    widths = np.diff(bs)[:, np.newaxis]
+    curvs = _curvatures(bs, ests)
+
+    interp_err = widths**2 * np.maximum(curvs[1:], curvs[:-1]) / 8
+    stat_err = (errs[1:] + errs[:-1]) / 2
+
+    return np.sum((interp_err + stat_err) / scale, axis=1)
+
+
+def find_peak(bs, values):
+    """
+    Locate the maximum of sampled values by parabolic interpolation
+
+    Fits a parabola through the largest value and its two neighbours.
+    Falls back to the largest sample if it is at the edge of the grid.
+
+    bs: (n,)-array -- sorted
+    values: (n,)-array
+    RETURNS: (float, float) -- location and height of the peak
+    """
+
+    bs = np.asarray(bs, dtype=float)
+    values = np.asarray(values, dtype=float)
+    k = np.argmax(values)
+
+    if k == 0 or k == len(bs) - 1:
+        return bs[k], values[k]
+
+    coeffs = np.polyfit(bs[k - 1:k + 2], values[k - 1:k + 2], 2)
+
+    if coeffs[0] >= 0:
+        return bs[k], values[k]
+
+    peak = -coeffs[1] / (2 * coeffs[0])
+
+    return peak, np.polyval(coeffs, peak)
+
+
+def plan_sweep(generate, observable, bmin, bmax, coarse=5, budget=20,
+               min_spacing=None, dataset=None, verbose=False):
+    """
+    Sweep over b, refining the grid where the observables change fastest
+
+    Starts with a uniform grid of coarse points, then repeatedly splits
+    the interval with the highest score (see interval_scores) until the
+    budget of ensembles runs out. This concentrates simulations around
+    peaks and steps, e.g.: near the critical temperature.
+
+    generate: callable -- takes b, returns a simulated datagen.Ensemble
+    observable: callable -- takes an Ensemble, returns (estimate, error)
+        as floats or (k,)-arrays for several observables at once
+    bmin, bmax: float
+    coarse: int -- number of points in the initial grid
+    budget: int -- total number of ensembles to generate
+    min_spacing: float -- never split intervals narrower than twice this,
+        defaults to (bmax - bmin) / (4 * budget)
+    dataset: datagen.DataSet OR None -- if given, every ensemble is added
+        and saved to it as soon as it is generated
+
+    RETURNS: bs -- (n,)-array, sorted
+             ests, errs -- (n,)- or (n, k)-arrays
+    """
+
+    if min_spacing is None:
+        min_spacing = (bmax - bmin) / (4 * budget)
+
+    bs = []
+    ests = []
+    errs = []
+
+    def measure(b):
+
+        if verbose:
+            print(f"Sweep point {len(bs) + 1}/{budget}: b={b:.4f}")
+
+        ens = generate(b)
+        est, err = observable(ens)
+
+        if dataset is not None:
+            dataset.add_ensemble(ens, save=True)
+
+        # Keep everything sorted by b
+        k = np.searchsorted(bs, b)
+        bs.insert(k, b)
+        ests.insert(k, est)
+        errs.insert(k, err)
+
+    for b in np.linspace(bmin, bmax, min(coarse, budget)):
+        measure(b)
+
+    while len(bs) < budget:
+
+        scores = interval_scores(np.array(bs), ests, errs)
+        scores[np.diff(bs) < 2 * min_spacing] = -np.inf
+
+        k = np.argmax(scores)
+        if scores[k] == -np.inf:
+            if verbose:
+                print("Grid is as fine as allowed, stopping early")
+            break
+
+        measure((bs[k] + bs[k + 1]) / 2)
+
+    return np.array(bs), np.array(ests), np.array(errs)
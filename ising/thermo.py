@@ -1,8 +1,67 @@
 """Determining thermodynamic properties from Ising model simulation"""
 
 import numpy as np
+from functools import wraps
 
 
+# Memory-mapped arrays are read in chunks of about this many bytes
+chunk_bytes = 2**26
+
+
+def _ischunks(a):
+    """Whether a is an iterator over chunks rather than an array"""
+
+    return hasattr(a, "__next__")
+
+
+def iter_chunks(a, chunksize=None):
+    """
+    Iterate over an array in chunks along its first axis
+
+    chunksize: int OR None -- defaults to about chunk_bytes per chunk
+
+    RETURNS: generator of arrays
+    """
+
+    if chunksize is None:
+        framesize = max(a[:1].nbytes, 1)
+        chunksize = max(chunk_bytes // framesize, 1)
+
+    for t in range(0, a.shape[0], chunksize):
+        yield np.asarray(a[t:t + chunksize])
+
+
+def blockwise(func):
+    """
+    Decorator for functions which act independently on every microstate
+
+    The decorated function also accepts:
+        - an iterator of (t, ..., Nx, Ny)-chunks, e.g.: from
+          Ensemble.iter_chunks() or iter_chunks(), in which case the
+          results for each chunk are concatenated along the first axis
+        - a memory-mapped array of microstates over time, (t, ..., Nx, Ny),
+          which is processed with iter_chunks(). Single microstates are
+          passed on as they are
+    so that only one chunk needs to be in memory at a time.
+    """
+
+    @wraps(func)
+    def wrapper(a, *args, **kwargs):
+
+        # A single (Nx, Ny) microstate has no time axis to chunk along
+        if isinstance(a, np.memmap) and a.ndim >= 3:
+            a = iter_chunks(a)
+
+        if _ischunks(a):
+            return np.concatenate([func(chunk, *args, **kwargs)
+                                   for chunk in a], axis=0)
+
+        return func(a, *args, **kwargs)
+
+    return wrapper
+
+
+@blockwise
 def magnetisation(a):
     """
     Calculate mean magnetisation
@@ -14,6 +73,7 @@ def magnetisation(a):
     return np.mean(a, axis=(-1, -2))
 
 
+@blockwise
 def square_mag(a):
     """
     Convenience function to calculate the square of magnetisation
@@ -22,21 +82,169 @@ def square_mag(a):
     return np.mean(a, axis=(-1, -2))**2
 
 
-def energy(a, h=0):
+def neighbour_sum(a, out=None, forward=False):
+    """
+    Sum the nearest neighbours of every spin, with periodic boundaries
+
+    The sum is built up in out using slices only, without any temporary
+    arrays, so it can be reused for local-field calculations.
+
+    a: (..., Nx, Ny)-array
+    out: (..., Nx, Ny)-array OR None -- preallocated output, must not
+        overlap with a. Its dtype must be able to hold the sum: for
+        int8 spins, any signed integer type will do.
+    forward: bool -- only sum the neighbours at (i+1, j) and (i, j+1),
+        which counts every nearest-neighbour pair exactly once
+
+    RETURNS: (..., Nx, Ny)-array -- out
+    """
+
+    if out is None:
+        out = np.empty_like(a)
+
+    # Neighbours at i+1 and j+1
+    out[..., :-1, :] = a[..., 1:, :]
+    out[..., -1, :] = a[..., 0, :]
+    out[..., :, :-1] += a[..., :, 1:]
+    out[..., :, -1] += a[..., :, 0]
+
+    if not forward:
+
+        # Neighbours at i-1 and j-1
+        out[..., 1:, :] += a[..., :-1, :]
+        out[..., 0, :] += a[..., -1, :]
+        out[..., :, 1:] += a[..., :, :-1]
+        out[..., :, 0] += a[..., :, -1]
+
+    return out
+
+
+def _accumulator(a):
+    """dtype to sum spins of a in, so that small int types can't overflow"""
+
+    return np.result_type(a.dtype, np.int64)
+
+
+def _field_energy(a, h):
+    """Sum of h * a over each microstate, without temporaries"""
+
+    h = np.asarray(h)
+
+    if h.ndim == 0:
+        return h * np.sum(a, axis=(-1, -2), dtype=_accumulator(a))
+    elif h.ndim == 1:  # one value per frame
+        spins = np.sum(a, axis=(-1, -2), dtype=_accumulator(a))
+        return h.reshape(h.shape + (1,) * (spins.ndim - 1)) * spins
+    elif h.ndim == 2:  # space-varying
+        return np.einsum("...ij,ij->...", a, h)
+    else:  # space-varying, one grid per frame
+        return np.einsum("t...ij,tij->t...", a, h)
+
+
+def energy(a, h=0, chunksize=None):
     """
     Calculate energy of a grid
 
-    Takes a (..., Nx, Ny)-array
+    Takes a (..., Nx, Ny)-array, or for (t, ..., Nx, Ny)-arrays also an
+    iterator of chunks or a memory-mapped array (see thermo.blockwise).
     Returns a (...,)-array
+
+    h: float OR (Nx, Ny)-array, or for (t, ..., Nx, Ny)-arrays also
+        one field per frame: (t,)- OR (t, Nx, Ny)-array
+    chunksize: int OR None -- frames to process at once, see iter_chunks
+
+    Only one chunk-sized buffer is allocated, however large a is.
     """
 
-    # Each nearest-neighbour pair is either bottom-top or left-right.
-    # To sum over every possible nearest-neighbour pair, generate
-    # all bottom-top pairs and left-right pairs separately and add
-    b = np.roll(a, 1, axis=-1)
-    c = np.roll(a, 1, axis=-2)
+    if not _ischunks(a) and np.ndim(a) == 2:
+        chunks = [a[np.newaxis, ...]]
+        h = np.asarray(h)[np.newaxis, ...] if np.ndim(h) > 0 else h
+        single = True
+    elif _ischunks(a):
+        chunks = a
+        single = False
+    else:
+        chunks = iter_chunks(a, chunksize)
+        single = False
+
+    framewise = np.ndim(h) in (1, 3)
+
+    energies = []
+    buf = None
+    t = 0
+
+    for chunk in chunks:
+
+        if buf is None or buf.shape != chunk.shape:
+            buf = np.empty(chunk.shape, dtype=chunk.dtype)
+
+        # Each nearest-neighbour pair is either bottom-top or left-right.
+        # Summing the forward neighbours of every spin counts every pair
+        # once, then the sum over pairs is a dot product with the spins
+        neighbour_sum(chunk, out=buf, forward=True)
+        bonds = np.einsum("...ij,...ij->...", buf, chunk,
+                          dtype=_accumulator(chunk))
+
+        chunk_h = h[t:t + chunk.shape[0]] if framewise else h
+        energies.append(-bonds - _field_energy(chunk, chunk_h))
+
+        t += chunk.shape[0]
 
-    return -np.sum((b + c + h) * a, axis=(-1, -2))
+    energies = np.concatenate(energies, axis=0)
+
+    return energies[0] if single else energies
+
+
+def heat_capacity(a, b, h=0, axis=0):
+    """
+    Calculate heat capacity via the fluctuation-dissipation theorem
+
+    C = b^2 var(E), with the variance taken over time (and/or systems)
+
+    a: (iternum, ..., Nx, Ny)-array
+    b: float
+    axis: int or tuple -- axes of energy(a) to take the variance over
+    RETURNS: (...,)-array
+    """
+
+    return b**2 * np.var(energy(a, h), axis=axis, ddof=1)
+
+
+def susceptibility(a, b, axis=0):
+    """
+    Calculate magnetic susceptibility via fluctuation-dissipation
+
+    chi = b Nx Ny var(|M|), using |M| because the finite systems flip
+    between up and down, which would make var(M) meaningless.
+
+    a: (iternum, ..., Nx, Ny)-array
+    b: float
+    axis: int or tuple -- axes of magnetisation(a) to take the variance over
+    RETURNS: (...,)-array
+    """
+
+    spinnum = a.shape[-1] * a.shape[-2]
+    mags = np.abs(magnetisation(a))
+
+    return b * spinnum * np.var(mags, axis=axis, ddof=1)
+
+
+def binder_cumulant(a, axis=0):
+    """
+    Calculate the Binder cumulant U = 1 - <M^4> / (3 <M^2>^2)
+
+    Goes from 0 at high temperature to 2/3 in the ordered phase, and is
+    ~independent of system size at the critical temperature.
+
+    a: (iternum, ..., Nx, Ny)-array
+    axis: int or tuple -- axes of magnetisation(a) to average over
+    RETURNS: (...,)-array
+    """
+
+    sqmags = magnetisation(a)**2
+
+    return 1 - np.mean(sqmags**2, axis=axis) / (
+        3 * np.mean(sqmags, axis=axis)**2)
 
 
 def autocovariance(samples, maxtau=None, axis=-1, rem_dc=True):
@@ -80,7 +288,12 @@ def autocorrelation(samples, maxtau=None, axis=-1):
 
 
 def rolling_average(values, window, axis=-1):
-    """Take rolling average of array over axis"""
+    """
+    Take rolling average of array over axis
+
+    values may also be an iterator of chunks along axis, in which case
+    the cumulative sum is carried over from one chunk to the next.
+    """
 
     # This solution is a bit messy because np.convolve only likes
     # 1d arrays and because slicing is messy if you need to take
@@ -89,12 +302,33 @@ def rolling_average(values, window, axis=-1):
     # Basic idea is: the difference in the cumulated sum before and
     # after the window divided by the window is the average
 
-    cs = np.cumsum(values, axis=axis)
-    l = values.shape[axis]
-    cs1 = np.take(cs, range(0, l - window), axis=axis)
-    cs2 = np.take(cs, range(window, l), axis=axis)
+    if not _ischunks(values):
+        values = iter([values])
+
+    averages = []
+    pending = None  # cumulative sums not yet at the start of a window
+
+    for chunk in values:
+
+        cs = np.cumsum(chunk, axis=axis)
 
-    return (cs2 - cs1) / window
+        if pending is not None:
+            cs = cs + np.take(pending, [-1], axis=axis)
+            cs = np.concatenate([pending, cs], axis=axis)
+
+        l = cs.shape[axis]
+
+        if l > window:
+            cs1 = np.take(cs, range(0, l - window), axis=axis)
+            cs2 = np.take(cs, range(window, l), axis=axis)
+            averages.append((cs2 - cs1) / window)
+
+        pending = np.take(cs, range(max(l - window, 0), l), axis=axis)
+
+    if not averages:
+        return np.take(pending, range(0), axis=axis) / window
+
+    return np.concatenate(averages, axis=axis)
 
 
 def isflat(testfunc, ensemble, timescale, tolerance, absolute=True):
@@ -102,7 +336,7 @@ def isflat(testfunc, ensemble, timescale, tolerance, absolute=True):
     Determines when and if a test function is ~constant over time
     over an ensemble
 
-    testfunc: callable -- must take a microstate
+    testfunc: callable -- takes a (..., Nx, Ny)-array of microstates
     ensemble: datagen.Ensemble
     tolerance: float
     absolute: bool -- whether to interpret tolerance as absolute or relative
@@ -134,3 +368,41 @@ def isflat(testfunc, ensemble, timescale, tolerance, absolute=True):
         isflats = smoothed_diffs / smoothed_avgs < tolerance
 
     return isflats
+
+
+def mser(series, batch=5, axis=-1):
+    """
+    Find the truncation point which best removes initial relaxation
+
+    Uses the MSER-m rule (marginal standard error rule on batch means of
+    size m): the truncation point d minimises the squared standard error
+    of the mean of the remaining series, var(x[d:]) / (n - d). The series
+    is usually considered to have reached equilibrium if d falls in its
+    first half.
+
+    series: (..., iternum, ...)-array
+    batch: int -- size of batches to average over before truncating
+    axis: int -- the time axis
+
+    RETURNS: int (...)-array -- truncation point, in unbatched time steps
+    """
+
+    series = np.moveaxis(np.asarray(series, dtype=float), axis, -1)
+    n = series.shape[-1] // batch
+
+    if n < 3:
+        return np.zeros(series.shape[:-1], dtype=int)
+
+    x = series[..., :n * batch].reshape(series.shape[:-1] + (n, batch))
+    x = np.mean(x, axis=-1)
+    x = x - np.mean(x, axis=-1, keepdims=True)
+
+    # Sums from d to the end of the series, for every d
+    s1 = np.cumsum(x[..., ::-1], axis=-1)[..., ::-1]
+    s2 = np.cumsum(x[..., ::-1]**2, axis=-1)[..., ::-1]
+    counts = n - np.arange(n)
+
+    stats = (s2 - s1**2 / counts) / counts**2
+
+    # The last couple of points always have tiny variance, ignore them
+    return np.argmin(stats[..., :n - 2], axis=-1) * batch
@@ -0,0 +1,191 @@
+"""
+Multithreaded simulation of very large lattices
+
+The grid is split into tiles which are updated in parallel by a thread
+pool, one checkerboard sublattice at a time. Every tile reads a one-spin
+halo around itself from the other sublattice, which is not being
+written to, so no locking is needed. NumPy releases the GIL inside its
+array operations and random number generation, which is where nearly
+all of the time is spent.
+
+The dynamics are checkerboard (sublattice) updates rather than the
+random-site sweeps of simulator.iterate(), see simulator.sublattices().
+"""
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from . import loadingbar, simulator
+
+
+class TiledLattice:
+    """Large grid of spins split into tiles for parallel updates"""
+
+    def __init__(self, spins, tiles=(4, 4), threads=None, seed=None,
+                 dynamics="heatbath"):
+        """
+        spins: int (Nx, Ny)-array -- Nx and Ny must be even. Modified
+            in-place by sweep()
+        tiles: (int, int) -- number of tiles along each axis
+        threads: int OR None -- size of the thread pool, defaults to
+            the number of tiles
+        seed: int OR None -- seed for the per-tile random generators
+        dynamics: "heatbath" OR "metropolis"
+        """
+
+        Nx, Ny = spins.shape
+
+        if Nx % 2 or Ny % 2:
+            raise ValueError("tiled lattices need even sides")
+        if dynamics not in ("heatbath", "metropolis"):
+            raise ValueError(f"unknown dynamics {dynamics}")
+
+        self.spins = spins
+        self.dynamics = dynamics
+
+        xs = np.linspace(0, Nx, tiles[0] + 1).astype(int)
+        ys = np.linspace(0, Ny, tiles[1] + 1).astype(int)
+
+        self.tiles = []
+
+        for i0, i1 in zip(xs[:-1], xs[1:]):
+            for j0, j1 in zip(ys[:-1], ys[1:]):
+
+                # Rows and columns of the tile including its halo
+                rows = np.arange(i0 - 1, i1 + 1) % Nx
+                cols = np.arange(j0 - 1, j1 + 1) % Ny
+
+                ii, jj = np.ix_(np.arange(i0, i1), np.arange(j0, j1))
+                masks = [(ii + jj) % 2 == c for c in (0, 1)]
+
+                self.tiles.append(((i0, i1, j0, j1), (rows, cols), masks))
+
+        # Independent random generators are thread-safe, one per tile
+        children = np.random.SeedSequence(seed).spawn(len(self.tiles))
+        self.rngs = [np.random.default_rng(child) for child in children]
+
+        self.pool = ThreadPoolExecutor(
+            max_workers=threads if threads else len(self.tiles))
+
+    def close(self):
+        self.pool.shutdown()
+
+    def _update_tile(self, k, colour, table):
+
+        (i0, i1, j0, j1), (rows, cols), masks = self.tiles[k]
+        mask = masks[colour]
+
+        # Halo exchange: copy the tile and its border out of the grid
+        padded = self.spins[rows[:, np.newaxis], cols[np.newaxis, :]]
+        tile = padded[1:-1, 1:-1]
+
+        nn = padded[:-2, 1:-1] + padded[2:, 1:-1]
+        nn += padded[1:-1, :-2]
+        nn += padded[1:-1, 2:]
+
+        rands = self.rngs[k].random(np.count_nonzero(mask))
+
+        if self.dynamics == "heatbath":
+            ups = rands < table[(nn[mask] + 4) // 2]
+            new = 2 * ups - 1
+        else:
+            s = tile[mask]
+            flip = rands < table[(s + 1) // 2, (s * nn[mask] + 4) // 2]
+            new = np.where(flip, -s, s)
+
+        self.spins[i0:i1, j0:j1][mask] = new
+
+    def sweep(self, b, h=0):
+        """
+        Update every spin once, one sublattice after the other
+
+        b, h: float
+        """
+
+        snn = np.arange(-4, 5, 2)
+
+        if self.dynamics == "heatbath":
+            table = 1 / (1 + np.exp(-2 * b * (snn + h)))
+        else:
+            # indexed by [(s + 1) // 2, (s * nn + 4) // 2]
+            table = np.minimum(1, np.exp(
+                -2 * b * (snn[np.newaxis, :] + np.array([[-h], [h]]))))
+
+        for colour in (0, 1):
+            list(self.pool.map(self._update_tile, range(len(self.tiles)),
+                               [colour] * len(self.tiles),
+                               [table] * len(self.tiles)))
+
+
+def run(init_spins, iternum, b=1, h=0, record_every=1, filename=None,
+        observables=None, tiles=(4, 4), threads=None, seed=None,
+        dynamics="heatbath", verbose=False):
+    """
+    Run a simulation of a large lattice, streaming snapshots to disk
+
+    init_spins: int (Nx, Ny)-array -- not modified
+    iternum: int -- number of iterations
+    b, h: float OR (iternum,)-array -- uniform, but can vary in time
+    record_every: int -- keep every record_every-th state
+    filename: str OR Path OR None -- if given, the snapshots are written
+        to this .npy file as they are produced, and never held in memory
+    observables: dict OR None -- name: callable, taking a (Nx, Ny)-array
+        and returning a float, evaluated on every snapshot
+    tiles, threads, seed, dynamics: see TiledLattice
+
+    RETURNS: final spins -- simulator.SPIN_DTYPE (Nx, Ny)-array
+             snapshots -- (iternum // record_every, Nx, Ny)-array,
+                memory-mapped if filename was given
+             series -- dict, name: (iternum // record_every,)-array
+    """
+
+    spins = np.array(init_spins, dtype=simulator.SPIN_DTYPE)
+    framenum = iternum // record_every
+
+    if filename is not None:
+        filename = Path(filename).with_suffix(".npy")
+        snapshots = np.lib.format.open_memmap(
+            filename, mode="w+", dtype=simulator.SPIN_DTYPE,
+            shape=(framenum,) + spins.shape)
+    else:
+        snapshots = np.empty((framenum,) + spins.shape,
+                             dtype=simulator.SPIN_DTYPE)
+
+    if observables is None:
+        observables = {}
+    series = {name: np.empty(framenum) for name in observables}
+
+    bs = np.broadcast_to(b, (iternum,))
+    hs = np.broadcast_to(h, (iternum,))
+
+    if verbose:
+        bar = loadingbar.LoadingBar(iternum)
+
+    lattice = TiledLattice(spins, tiles, threads, seed, dynamics)
+
+    try:
+
+        for k in range(iternum):
+
+            lattice.sweep(bs[k], hs[k])
+
+            if (k + 1) % record_every == 0:
+
+                frame = (k + 1) // record_every - 1
+                snapshots[frame] = spins
+
+                for name, func in observables.items():
+                    series[name][frame] = func(spins)
+
+            if verbose:
+                bar.print_next()
+
+    finally:
+
+        lattice.close()
+
+        if filename is not None:
+            snapshots.flush()
+
+    return spins, snapshots, series
@@ -5,7 +5,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 from pathlib import Path
 
-from ising import simulator, plotter, thermo, datagen
+from ising import simulator, plotter, thermo, datagen, convergence, sweep, scaling
 
 
 datapath = Path(__file__).parents[0] / "data/scaling"
@@ -22,7 +22,6 @@ def find_heat_capacity(N, T, tol, sysnum=20):
     # As soon as the heat capacity is found to a suitable tolerance,
     # return that value.
 
-    relaxtime = 150
     maxtime = 5000
     checktime = 50
     sysnum = 100
@@ -33,44 +32,24 @@ def find_heat_capacity(N, T, tol, sysnum=20):
     ensemble = datagen.Ensemble(N, sysnum, p=1, b=b, h=0, randflip=True)
 
     # initial simulation to reach equilibrium
-    ensemble.simulate(relaxtime + 10)
-    ensemble.trim_init(relaxtime)
+    ensemble.equilibrate(checktime=checktime)
 
-    total_iterations = 10
+    def cap_estimate(stats):
 
-    done = False
-
-    while total_iterations < maxtime and not done:
-
-        print(end=f"Simulating {total_iterations} -> "
-              f"{total_iterations + checktime}: ")
-
-        ensemble.simulate(checktime, reset=False)
-
-        arr = ensemble.asarray()
-        energies = thermo.energy(arr)
-
-        flucts = np.std(energies, ddof=1, axis=0)
-        est_fluct = np.mean(flucts)
-        err_fluct = np.std(flucts, ddof=1) / np.sqrt(sysnum)
+        est_fluct, err_fluct = convergence.fluct_estimate(stats["energy"])
 
         # Error propagation!
-
         est_cap = est_fluct**2 * b**2
         err_cap = 2 * err_fluct * est_fluct * b**2
 
-        rel_err = err_cap / est_cap
-
-        print(
-            f"|err_caps / cap| = |{err_cap:.3f} / {est_cap:.3f}| = {rel_err:.3f}")
+        return est_cap, err_cap
 
-        if rel_err < tol:
-            done = True
+    estimates, _ = convergence.simulate_until(
+        ensemble, {"cap": cap_estimate}, {"cap": tol},
+        observables={"energy": thermo.energy},
+        checktime=checktime, maxtime=maxtime, verbose=True)
 
-        total_iterations += checktime
-
-    if not done:
-        print(f"Exceeded max time of {maxtime}")
+    est_cap, err_cap = estimates["cap"]
 
     return est_cap, err_cap
 
@@ -94,6 +73,41 @@ def calculate(Ns, Ts, tol):
         np.save(datapath / f"errs-N{N}.npy", np.array(errs))
 
 
+def calculate_adaptive(Ns, budget=30, iternum=1000, sysnum=100):
+    """
+    Like calculate(), but sweep.plan_sweep() chooses the temperatures
+
+    The heat capacity peak gets most of the runs, instead of spending
+    them evenly over the whole temperature range.
+    """
+
+    for N in Ns:
+
+        dataset = datagen.DataSet(datapath / f"N{N}")
+
+        def generate(b):
+
+            ensemble = datagen.Ensemble(N, sysnum, p=1, b=b, h=0,
+                                        randflip=True)
+            ensemble.equilibrate()
+            ensemble.simulate(iternum - ensemble.iternum, reset=False)
+
+            return ensemble
+
+        def observable(ensemble):
+
+            caps = thermo.heat_capacity(ensemble.asarray(), ensemble.b)
+            return np.mean(caps), np.std(caps, ddof=1) / np.sqrt(sysnum)
+
+        bs, ests, errs = sweep.plan_sweep(
+            generate, observable, bmin=1 / 5, bmax=1, coarse=8,
+            budget=budget, dataset=dataset, verbose=True)
+
+        np.save(datapath / f"adaptive-Ts-N{N}.npy", 1 / bs)
+        np.save(datapath / f"adaptive-ests-N{N}.npy", ests)
+        np.save(datapath / f"adaptive-errs-N{N}.npy", errs)
+
+
 def results(Ns, Ts):
 
     plt.figure(figsize=(12, 8))
@@ -126,6 +140,25 @@ def results(Ns, Ts):
     plt.close()
 
 
+def critical_temperatures(Ns, Ts, nboot=200):
+    """
+    Locate the heat capacity peak for each N
+
+    Errors are found by resampling the heat capacities within their
+    error bars and locating the peaks again.
+    """
+
+    ests = np.stack([np.load(datapath / f"ests-N{N}.npy") for N in Ns])
+    errs = np.stack([np.load(datapath / f"errs-N{N}.npy") for N in Ns])
+
+    Tcs, _ = scaling.find_peaks(Ts, ests)
+
+    samples = ests + errs * np.random.randn(nboot, *ests.shape)
+    Tc_samples, _ = scaling.find_peaks(Ts, samples)
+
+    return Tcs, np.std(Tc_samples, axis=0, ddof=1)
+
+
 ranges = [
     (1, 2, 0.2),
     (2, 4, 0.025),
@@ -139,8 +172,9 @@ Ts = np.concatenate([np.arange(*r) for r in ranges])
 
 # results(Ns, Ts)
 
-Tcs = [2.6, 2.47, 2.45, 2.41, 2.4, 2.37, 2.36]
-errs = [.1, .08, .07, .06, .06, .03, .04]
+Tcs, errs = critical_temperatures(Ns, Ts)
+Tc_inf, _, nu = scaling.fit_critical(Ns, Tcs, nus=[1])
+print(f"Extrapolated T_c = {Tc_inf:.3f}")
 
 plt.errorbar(Ns, Tcs, errs,
     fmt="x", color="k", ecolor="r", elinewidth=2)
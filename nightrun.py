@@ -11,11 +11,13 @@ def gen_relaxation(chunknum, chunksize, dset_select="aligned"):
     Simulate chunknum*chunksize steps for the aligned dataset
 
     chunksize is just passed as iternum to the ensemble.simulate()
-    and after each chunk the data is saved.
+    and after each chunk the data is saved, in the background while
+    the next ensemble is simulated.
     """
 
     datapath = Path(__file__).parents[0] / "data/relaxation"
-    dataset = datagen.DataSet(datapath / f"init_{dset_select}")
+    dataset = datagen.DataSet(datapath / f"init_{dset_select}",
+                              background=True)
     dataset.load()
 
     print(f"Generating {chunknum} chunks of size {chunksize}")
@@ -35,6 +37,8 @@ def gen_relaxation(chunknum, chunksize, dset_select="aligned"):
             ens.simulate(chunksize, reset=False, verbose=True)
             dataset.save(ens_index=k)
 
+    dataset.close()
+
 
 if __name__ == "__main__":
 
@@ -6,7 +6,7 @@ from scipy.stats import linregress
 from pathlib import Path
 from warnings import warn
 
-from ising import datagen, loadingbar, plotter, simulator, thermo
+from ising import datagen, export, loadingbar, plotter, simulator, thermo
 
 
 datapath = Path(__file__).parents[1] / "data/autoc-new"
@@ -44,9 +44,15 @@ maxtau = 100
 
 
 def generate(wipe, iternum, relaxtime=None, bmin=0, bmax=1):
-    """Generate and save all required data"""
+    """
+    Generate and save all required data
 
-    dataset = datagen.DataSet(datapath)
+    relaxtime: int OR "auto" -- if "auto", equilibrium is detected
+        separately for every ensemble
+    """
+
+    # Saving happens in the background, while the next ensemble runs
+    dataset = datagen.DataSet(datapath, background=True)
 
     assert type(wipe) is bool
 
@@ -70,10 +76,26 @@ def generate(wipe, iternum, relaxtime=None, bmin=0, bmax=1):
             print(f"k: {k} >> N={N}, b={b:.2f}")
             ens = datagen.Ensemble(N, sysnum=sysnum, p=p,
                                    b=b, h=0, randflip=True)
-            ens.simulate(iternum + relaxtime, verbose=True)
+            if relaxtime == "auto":
+
+                # Detect equilibrium and remove the relaxation time
+                ens.equilibrate()
+                print(f"Detected relaxation time: {ens.relaxtime}")
+
+                # Detection can leave more than iternum states, which are
+                # all equilibrated, so keep the last iternum of them
+                if ens.iternum < iternum:
+                    ens.simulate(iternum - ens.iternum, reset=False,
+                                 verbose=True)
+                else:
+                    ens.trim_init(ens.iternum - iternum)
 
-            # Remove the relaxation time
-            ens.trim_init(relaxtime)
+            else:
+
+                ens.simulate(iternum + relaxtime, verbose=True)
+
+                # Remove the relaxation time
+                ens.trim_init(relaxtime)
 
             dataset.add_ensemble(ens, save=True)
 
@@ -95,14 +117,16 @@ def generate(wipe, iternum, relaxtime=None, bmin=0, bmax=1):
                 ens.simulate(iternum, reset=False, verbose=True)
                 dataset.save(ens_index=k)
 
+    dataset.close()
+
 
 def display_mosaic(k):
     """For testing"""
 
     dataset = datagen.DataSet(datapath)
-    dataset.load()
+    dataset.load(select=[k])
 
-    ens = dataset.ensembles[k]
+    ens = dataset.ensembles[0]
 
     print(f"Nb: {k_to_Nbs[k]}")
 
@@ -130,7 +154,7 @@ def analyse():
 
     print("Loading data")
     dataset = datagen.DataSet(datapath)
-    dataset.load()
+    dataset.load(mmap=True)
 
     # e-folding times
     tau_es = []
@@ -144,12 +168,10 @@ def analyse():
 
         bar.print_next()
 
-        ens_arr = ens.asarray()
-
         # 1. Calculate the magnetisation as a function of time
         #    and save to file
 
-        mags = thermo.magnetisation(ens_arr)
+        mags = thermo.magnetisation(ens.iter_chunks())
         np.save(datapath / f"mags-{k}.npy", mags)
 
         # 2. Calculate the autocorrelation as a function of tau (time lag)
@@ -284,19 +306,14 @@ def results():
 def mosaics(ks):
 
     dataset = datagen.DataSet(datapath)
-    dataset.load()
+    dataset.load(select=ks)
 
-    for k in ks:
-
-        ens = dataset.ensembles[k]
+    for k, ens in zip(ks, dataset.ensembles):
 
         N, b = ens.grid_shape[0], ens.b
     
         print(f"k{k} | N{ens.grid_shape[0]} b{ens.b}")
-        fig, _, _ = plotter.animate_mosaic(
-            ens, timestamp=True,
-            saveas=resultspath / f"mosaic-{k}.mp4"
-        )
+        export.save_mosaic(ens, resultspath / f"mosaic-{k}.mp4")
 
 
 def randflip():
@@ -306,10 +323,12 @@ def randflip():
     # spin up, half systems fully aligned spin down)
 
     dataset = datagen.DataSet(datapath)
-    dataset.load()
+    # Memory-mapped, so the flips are only recorded in the metadata
+    dataset.load(mmap=True)
 
     for k, ens in enumerate(dataset.ensembles):
 
         print(k)
         ens.do_randflip()
-        dataset.save(k)
+
+    dataset.save_signs()
@@ -18,29 +18,25 @@ resultspath = Path(__file__).parents[1] / "results/meanmag"
 
 
 def create_dataset():
-    """Creates the mainmag dataset from the autoc dataset"""
+    """
+    Creates the mainmag dataset from the autoc dataset
+
+    The new dataset is a view of the N=30 ensembles of the autoc dataset,
+    so no data is copied.
+    """
 
-    print("Loading autoc data")
     autocdataset = datagen.DataSet(autocdatapath)
-    autocdataset.load()
 
-    print("Preparing new dataset for copying")
+    print("Preparing new dataset")
     newdataset = datagen.DataSet(datapath)
     newdataset.wipe()
 
-    newk = 0
-
-    for k, ens in enumerate(autocdataset.ensembles):
-
-        N, b = ens.grid_shape[0], ens.b
-
-        if N == 30:
+    newdataset = autocdataset.derive(
+        datapath, select=lambda md: md["grid_shape"][0] == 30)
 
-            print(f"Adding {k} as {newk} | "
-                  f"N={N} b={b:.2f} t={ens.iternum}")
-
-            newk += 1
-            newdataset.add_ensemble(ens, save=True)
+    for newk, ens in enumerate(newdataset.ensembles):
+        print(f"Added as {newk} | "
+              f"N={ens.grid_shape[0]} b={ens.b:.2f} t={ens.iternum}")
 
 
 def randflip():
@@ -49,13 +45,15 @@ def randflip():
     # See tasks.autoc.randflip() for explanation
 
     dataset = datagen.DataSet(datapath)
-    dataset.load()
+    # Memory-mapped, so the flips are only recorded in the metadata
+    dataset.load(mmap=True)
 
     for k, ens in enumerate(dataset.ensembles):
 
         print(k)
         ens.do_randflip()
-        dataset.save(k)
+
+    dataset.save_signs()
 
 
 def _load_dataset():
@@ -17,6 +17,10 @@ def generate(datapath, grid_size=30, sysnum=100, maxiternum=500):
     init_aligned_dataset = datagen.DataSet(datapath / "init_aligned")
     init_random_dataset = datagen.DataSet(datapath / "init_random")
 
+    # Saved ensembles are added to what is on disk, so start afresh
+    init_aligned_dataset.wipe()
+    init_random_dataset.wipe()
+
     # Shared parameters
     h = 0
 
@@ -63,14 +67,14 @@ def display_mosaic(datapath, dataset_select, ensemble_select):
     else:
         raise ValueError(f"what is {dataset_select}?")
 
-    dataset.load()
-
     if type(ensemble_select) is not int:
         raise ValueError("bad input")
     if ensemble_select < 0 or ensemble_select > 10:
         raise ValueError("please input an int from 0 to 10 inclusive")
 
-    ens = dataset.ensembles[ensemble_select]
+    dataset.load(select=[ensemble_select])
+
+    ens = dataset.ensembles[0]
     plotter.animate_mosaic(ens, show=True)
 
 